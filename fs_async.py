@@ -0,0 +1,160 @@
+# -*- coding: UTF-8 -*-
+"""
+asyncio同步引擎模块
+
+作为Slaves中ThreadPool工作线程的可选替代(sync_engine = asyncio)：
+    1. 一个取任务线程阻塞在TaskQueue上，任务入队即被唤醒，取到后交给事件循环；
+    2. 所有rsync在同一个事件循环中通过create_subprocess_exec并发执行，
+        同时处理的批次数和每个对端的并发同步数分别由队列和信号量限制，
+        不再一个同步占用一个系统线程。
+
+注：仅支持python3，且只使用批量同步方式
+"""
+import os
+import time
+import signal
+import asyncio
+import threading
+from fs_logger import Logger
+from fs_util import Common
+from fs_data import TaskQueue
+from fs_connect import BandwidthGovernor, CompressAdvisor
+
+
+class AsyncEngine(object):
+    """ asyncio同步引擎，提供与ThreadPool一致的start/pause/resume接口 """
+
+    def __init__(self, slaves, concurrency):
+        self.slaves = slaves
+        self.concurrency = concurrency
+        self.loop = None
+        self._ready = threading.Event()
+        self._pause_flag = threading.Event()
+        self._pause_flag.set()
+        self._batch_ids = None
+        self._remote_sems = {}
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        Common.start_thread(target=self._run_loop)
+        Common.start_thread(target=self._feed)
+
+    def pause(self):
+        self._pause_flag.clear()
+
+    def resume(self):
+        self._pause_flag.set()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        # 空闲批次号，同时也限制同时处理的批次数
+        self._batch_ids = asyncio.Queue()
+        [self._batch_ids.put_nowait(i) for i in range(self.concurrency)]
+        self._ready.set()
+        self.loop.run_forever()
+
+    def _feed(self):
+        """ 取任务线程，任务入队即被唤醒，没有空闲批次号时阻塞 """
+        self._ready.wait()
+        _pause_wait = self._pause_flag.wait
+        _request = TaskQueue.request
+        while True:
+            _pause_wait()
+            # 定时醒来以响应暂停
+            task_list = _request(timeout=1)
+            if not task_list:
+                continue
+            asyncio.run_coroutine_threadsafe(self._submit(task_list),
+                                             self.loop).result()
+
+    async def _submit(self, task_list):
+        batch_id = await self._batch_ids.get()
+        self.loop.create_task(self._handle(batch_id, task_list))
+
+    def _remote_sem(self, ip):
+        if ip not in self._remote_sems:
+            self._remote_sems[ip] = asyncio.Semaphore(self.slaves.remote_limit)
+        return self._remote_sems[ip]
+
+    async def _handle(self, batch_id, task_list):
+        thread_id = 'Async%s' % batch_id
+        _slaves = self.slaves
+        try:
+            Logger.info("[thread%s] got %s tasks:\n%s"
+                        % (thread_id, len(task_list), '\n'.join(task_list)))
+            collision = []
+            for tasks in [task_list, collision]:
+                # 分组时会登录对端创建目录，放到线程池中执行
+                groups = await self.loop.run_in_executor(
+                    None, _slaves.group_tasks, thread_id, tasks,
+                    collision if tasks is task_list else None)
+                await asyncio.gather(*[self._sync_group(thread_id, listen, last, _tasks)
+                                       for (listen, last), _tasks in groups.items()])
+        except Exception as e:
+            Logger.error("[thread%s] async sync failed: %s" % (thread_id, e))
+        finally:
+            TaskQueue.done(task_list)
+            self._batch_ids.put_nowait(batch_id)
+
+    async def _sync_group(self, thread_id, listen, last, task_list):
+        _slaves = self.slaves
+        _slaves.syncing.extend(task_list)
+        try:
+            # 组合参数时会写files-from文件、按需读取文件采样压缩率，放到线程池中执行
+            base, cmd_dict = await self.loop.run_in_executor(
+                None, _slaves.combine_batch, thread_id, listen, last, task_list)
+            ips = list(cmd_dict)
+            results = await asyncio.gather(*[self._rsync(ip, cmd_dict[ip]) for ip in ips])
+            results = dict(zip(ips, results))
+            _slaves.feedback(listen, last, task_list, results)
+            _slaves.report_batch(thread_id, listen, base, task_list, results, False)
+        finally:
+            [_slaves.syncing.remove(task) for task in task_list]
+
+    async def _rsync(self, ip, cmd):
+        """
+        异步执行rsync，受对端并发数和带宽分配限制；
+        与Executor一致，子进程运行在独立进程组中，超时后整组kill
+
+        返回值：
+            退出值, 输出, 错误输出, 耗时
+        """
+        async with self._remote_sem(ip):
+            limit = BandwidthGovernor.acquire(ip, False)
+            start = time.time()
+            result = 0, '', '', 0
+            try:
+                result = await self._exec(BandwidthGovernor.govern(cmd, limit))
+            finally:
+                BandwidthGovernor.release(ip, False, limit, result[1], time.time() - start)
+            CompressAdvisor.observe(ip, cmd, result[1], result[3])
+            return result
+
+    async def _exec(self, cmd):
+        """ 执行一条命令，返回值同_rsync """
+        Logger.debug("[fs_async] exec: %s" % ' '.join(cmd))
+        start = time.time()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+        except OSError as e:
+            return 127, '', '%s: %s' % (cmd[0], e), time.time() - start
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(),
+                                              self.slaves.rsync_timeout)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            await proc.wait()
+            return proc.returncode, '', 'timeout after %ss, killed' \
+                % self.slaves.rsync_timeout, time.time() - start
+        return (proc.returncode,
+                out.decode('utf-8', 'replace'),
+                err.decode('utf-8', 'replace'),
+                time.time() - start)
@@ -0,0 +1,676 @@
+# -*- coding: UTF-8 -*-
+"""
+SSH连接管理模块
+
+本模块功能：
+    1. 为每个可达的对端IP维持一个SSH复用主连接(ControlMaster)，
+        rsync(--rsh)和对端建目录等ssh命令通过该连接复用会话，免去每次密钥交换；
+    2. 定期检查主连接状态，断开后自动重建；
+    3. 对端熔断：连续同步失败的对端暂停分发任务，探测恢复后再分发；
+    4. 对端可达性探测：单线程并发连接各对端SSH端口，统计连接时延；
+    5. 对端带宽分配：按链路容量和同时进行的同步数为每次rsync设置--bwlimit；
+    6. 自适应压缩：按文件类型的压缩率和对端链路吞吐为每次rsync选择压缩级别。
+"""
+import os
+import re
+import stat
+import time
+import zlib
+import errno
+import select
+import socket
+import fs_global as Global
+from fs_logger import Logger
+from fs_util import Common, Executor
+from threading import Lock
+from fs_data import ConfigWrapper
+
+
+def _rsync_stat(out, name):
+    """ 从rsync --stats输出中取出一项字节数，如: Total bytes sent: 1,234 """
+    match = re.search(r'^%s: ([\d,.]+)' % name, out or '', re.M)
+    return int(re.sub(r'[,.]', '', match.group(1))) if match else 0
+
+
+class SshPool:
+    """ SSH复用连接池 """
+    _enable = True
+    _control_path = ''
+    _ssh_cmd = 'ssh'
+    _ssh_argv = ['ssh']
+    _timeout = 30
+    _masters = set()
+
+    @classmethod
+    def init(cls):
+        """ 可选项，是否开启SSH连接复用，默认开启 """
+        cls._enable = (ConfigWrapper.get_key_value('ssh_multiplex') or 'true') == 'true'
+        # unix socket路径长度有限，使用短格式
+        cls._control_path = Common.join_path(Global.G_RUN_DIR, 'ssh-%r@%h:%p')
+        cls._ssh_argv = ['ssh'] + cls._options(False) if cls._enable else ['ssh']
+        cls._ssh_cmd = ' '.join(cls._ssh_argv)
+        Logger.info('[fs_connect] ssh multiplex: %s' % cls._enable)
+
+    @classmethod
+    def _options(cls, master):
+        return ['-o', 'BatchMode=yes',
+                '-o', 'ConnectTimeout=10',
+                '-o', 'ServerAliveInterval=15',
+                '-o', 'ControlMaster=%s' % ('yes' if master else 'no'),
+                '-o', 'ControlPath=%s' % cls._control_path]
+
+    @classmethod
+    def ssh_cmd(cls):
+        """
+        获取复用主连接的ssh命令，用于rsync --rsh
+
+        主连接不存在时ssh会直接建立新连接，因此不影响同步
+        """
+        return cls._ssh_cmd
+
+    @classmethod
+    def ssh_argv(cls):
+        """ 获取复用主连接的ssh命令参数列表 """
+        return list(cls._ssh_argv)
+
+    @classmethod
+    def _target(cls, ip):
+        return '%s@%s' % (Global.G_RSYNC_USER, ip)
+
+    @classmethod
+    def is_alive(cls, ip):
+        return not Common.exec_ret(['ssh'] + cls._options(False) +
+                                   ['-O', 'check', cls._target(ip)], cls._timeout)
+
+    @classmethod
+    def connect(cls, ip):
+        """ 后台建立主连接，不读取输出，避免阻塞在常驻进程持有的管道上 """
+        ret = Executor.run(['ssh', '-fN'] + cls._options(True) + [cls._target(ip)],
+                           cls._timeout, output=False)[0]
+        if ret:
+            Logger.warn('[fs_connect] ssh master to %s failed, ret:%s' % (ip, ret))
+            return False
+        Logger.info('[fs_connect] ssh master to %s established' % ip)
+        return True
+
+    @classmethod
+    def disconnect(cls, ip):
+        cls._masters.discard(ip)
+        Common.exec_ret(['ssh'] + cls._options(False) +
+                        ['-O', 'exit', cls._target(ip)], cls._timeout)
+
+    @classmethod
+    def keepalive(cls, ip_list):
+        """
+        检查主连接状态
+
+        可达IP的主连接断开后重建，不可达IP的主连接关闭
+        """
+        if not cls._enable:
+            return
+        for ip in list(cls._masters):
+            if ip not in ip_list:
+                Logger.info('[fs_connect] close ssh master to %s' % ip)
+                cls.disconnect(ip)
+        for ip in ip_list:
+            if cls.is_alive(ip):
+                cls._masters.add(ip)
+                continue
+            if ip in cls._masters:
+                Logger.warn('[fs_connect] ssh master to %s lost, reconnect' % ip)
+            if cls.connect(ip):
+                cls._masters.add(ip)
+            else:
+                cls._masters.discard(ip)
+
+    @classmethod
+    def close(cls):
+        for ip in list(cls._masters):
+            cls.disconnect(ip)
+
+    @classmethod
+    def status(cls):
+        return sorted(cls._masters)
+
+
+class RemoteBreaker:
+    """
+    对端熔断器
+
+    对端连续出现连接层失败(ssh失败、协议或网络错误、超时)达到阈值后熔断，
+    熔断期间不再向该对端分发同步，任务进入失败重传队列，到下次探测时只重传到该对端；
+    冷却时间到后由链路检测线程探测，探测成功才恢复，失败则冷却时间加倍
+    """
+    # rsync连接层错误码：协议启动失败、socket错误、数据流错误、收发超时、连接超时、ssh失败
+    _REMOTE_ERRORS = (5, 10, 12, 30, 35, 255)
+    _threshold = 5
+    _cooldown = 30
+    _max_cooldown = 600
+    # {IP: 连续失败次数}
+    _failures = {}
+    # {IP: [可以探测的时间, 本次冷却时间]}
+    _opened = {}
+
+    @classmethod
+    def init(cls):
+        """ 可选项，连续失败次数阈值，默认5；熔断冷却时间(秒)，默认30，最长600 """
+        cls._threshold = int(ConfigWrapper.get_key_value('breaker_threshold') or 5)
+        cls._cooldown = float(ConfigWrapper.get_key_value('breaker_cooldown') or 30)
+        cls._max_cooldown = float(ConfigWrapper.get_key_value('breaker_max_cooldown') or 600)
+
+    @classmethod
+    def is_remote_error(cls, ret):
+        """ 被信号杀死(超时)也算连接层失败 """
+        return ret < 0 or ret in cls._REMOTE_ERRORS
+
+    @classmethod
+    def allow(cls, ip):
+        return ip not in cls._opened
+
+    @classmethod
+    def resume_at(cls, ip):
+        """ 熔断对端最早可能恢复的时间，探测已到期时再等待一个冷却时间 """
+        now = time.time()
+        due = cls._opened.get(ip, [now])[0]
+        return due if due > now else now + cls._cooldown
+
+    @classmethod
+    def record(cls, ip, ret):
+        """ 记录一次到对端的执行结果 """
+        if not cls.is_remote_error(ret):
+            cls._failures.pop(ip, None)
+            return
+        count = cls._failures.get(ip, 0) + 1
+        cls._failures[ip] = count
+        if count >= cls._threshold and ip not in cls._opened:
+            Logger.warn('[fs_connect] %s failed %s times, stop dispatching for %ss'
+                        % (ip, count, cls._cooldown))
+            cls._opened[ip] = [time.time() + cls._cooldown, cls._cooldown]
+
+    @classmethod
+    def probe(cls, ping):
+        """
+        探测冷却时间已到的熔断对端
+
+        参数：
+            ping: 探测函数，参数为IP，返回执行退出值
+        """
+        now = time.time()
+        for ip, (due, cooldown) in list(cls._opened.items()):
+            if due > now:
+                continue
+            ret = ping(ip)
+            if not ret:
+                Logger.info('[fs_connect] %s probe success, resume dispatching' % ip)
+                cls._failures.pop(ip, None)
+                del cls._opened[ip]
+                continue
+            cooldown = min(cooldown * 2, cls._max_cooldown)
+            Logger.warn('[fs_connect] %s probe failed (ret:%s), retry after %ss' % (ip, ret, cooldown))
+            cls._opened[ip] = [now + cooldown, cooldown]
+
+    @classmethod
+    def status(cls):
+        return sorted(cls._opened)
+
+
+class _ProbeState(object):
+    __slots__ = ('up', 'successes', 'failures', 'srtt', 'rttvar', 'rtt')
+
+    def __init__(self, up):
+        self.up = up
+        # 连续成功/失败次数
+        self.successes = 0
+        self.failures = 0
+        # 平滑时延及其偏差(秒)，算法同TCP的RTO估计
+        self.srtt = None
+        self.rttvar = None
+        self.rtt = None
+
+
+class TcpProber:
+    """
+    对端可达性探测
+
+    单线程非阻塞地同时连接所有对端的SSH端口，连接建立即认为可达，
+    不再每个对端一个线程和一个ping进程，且反映的是SSH服务本身是否可用；
+    连接建立耗时作为往返时延，按TCP的方式平滑；
+    可达状态带滞回：连续失败down_count次才判为不可达，连续成功up_count次才恢复
+    """
+    _port = 22
+    _timeout = 3
+    _up_count = 2
+    _down_count = 3
+    _ALPHA = 0.125
+    _BETA = 0.25
+    # {IP: _ProbeState}
+    _states = {}
+
+    @classmethod
+    def init(cls):
+        """ 可选项：SSH端口，默认22；连接超时(秒)，默认3；恢复/判定不可达所需的连续次数，默认2/3 """
+        cls._port = int(ConfigWrapper.get_key_value('ssh_port') or 22)
+        cls._timeout = float(ConfigWrapper.get_key_value('probe_timeout') or 3)
+        cls._up_count = int(ConfigWrapper.get_key_value('probe_up_count') or 2)
+        cls._down_count = int(ConfigWrapper.get_key_value('probe_down_count') or 3)
+
+    @classmethod
+    def connect_all(cls, ip_list):
+        """
+        同时连接各对端的SSH端口
+
+        返回值：
+            {IP: 连接建立耗时(秒)，失败或超时为None}
+        """
+        result, pending = {}, {}
+        poller = select.poll()
+        for ip in ip_list:
+            family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+            sock = None
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                start = time.time()
+                err = sock.connect_ex((ip, cls._port))
+            except (socket.error, socket.gaierror) as e:
+                # 主机名解析失败、文件描述符耗尽等，该对端按不可达处理
+                Logger.warn("[fs_connect] probe %s failed: %s" % (ip, e))
+                err = e
+            if err not in (0, errno.EINPROGRESS):
+                if sock is not None:
+                    sock.close()
+                result[ip] = None
+                continue
+            pending[sock.fileno()] = (sock, ip, start)
+            poller.register(sock, select.POLLOUT)
+        deadline = time.time() + cls._timeout
+        while pending:
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+            try:
+                events = poller.poll(wait * 1000)
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            now = time.time()
+            for fd, _ in events:
+                sock, ip, start = pending.pop(fd)
+                poller.unregister(fd)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                result[ip] = None if err else now - start
+                sock.close()
+        for sock, ip, _ in pending.values():
+            sock.close()
+            result[ip] = None
+        return result
+
+    @classmethod
+    def _update(cls, ip, rtt):
+        state = cls._states.get(ip)
+        if state is None:
+            # 首次探测直接决定状态，启动时不必等待多轮
+            state = cls._states[ip] = _ProbeState(rtt is not None)
+        if rtt is None:
+            state.successes = 0
+            state.failures += 1
+            if state.up and state.failures >= cls._down_count:
+                Logger.warn('[fs_connect] %s ssh port unreachable %s times, mark down'
+                            % (ip, state.failures))
+                state.up = False
+            return state.up
+        state.failures = 0
+        state.successes += 1
+        state.rtt = rtt
+        if state.srtt is None:
+            state.srtt, state.rttvar = rtt, rtt / 2
+        else:
+            state.rttvar = (1 - cls._BETA) * state.rttvar + cls._BETA * abs(state.srtt - rtt)
+            state.srtt = (1 - cls._ALPHA) * state.srtt + cls._ALPHA * rtt
+        if not state.up and state.successes >= cls._up_count:
+            Logger.info('[fs_connect] %s ssh port reachable %s times, mark up'
+                        % (ip, state.successes))
+            state.up = True
+        return state.up
+
+    @classmethod
+    def probe(cls, ip_list):
+        """
+        探测一轮并更新各对端状态
+
+        返回值：
+            {IP: 是否可达(经过滞回)}
+        """
+        result = dict((ip, cls._update(ip, rtt))
+                      for ip, rtt in cls.connect_all(ip_list).items())
+        # 不再配置的对端不再保留状态
+        for ip in [ip for ip in cls._states if ip not in result]:
+            del cls._states[ip]
+        return result
+
+    @classmethod
+    def rtt(cls, ip):
+        """ 平滑往返时延(秒)，没有数据时返回None """
+        state = cls._states.get(ip)
+        return state.srtt if state else None
+
+    @classmethod
+    def status(cls):
+        return dict((ip, '%s srtt=%s' % ('up' if state.up else 'down',
+                                          '%.1fms' % (state.srtt * 1000) if state.srtt is not None else '-'))
+                    for ip, state in cls._states.items())
+
+
+class _Link(object):
+    __slots__ = ('capacity', 'weight', 'reserved')
+
+    def __init__(self, capacity):
+        # 当前估计的链路容量(KB/s)
+        self.capacity = capacity
+        # 进行中的同步的权重之和
+        self.weight = 0
+        # 已分配出去的带宽，{是否批量: KB/s}
+        self.reserved = {True: 0.0, False: 0.0}
+
+
+class BandwidthGovernor:
+    """
+    对端带宽分配
+
+    rsync启动后不能再调整限速，因此每次同步开始时按令牌桶方式分配带宽：
+        1. 同时进行的同步按权重分享链路容量，增量同步权重是批量同步
+           (全量同步、大文件)的4倍；
+        2. 已分配的带宽在同步结束后归还，新同步最多拿到未分配的容量，
+           至少拿到最低份额；增量同步优先，批量同步合计不超过
+           增量同步占用之外容量的bulk_share，为后续增量同步留出余量；
+        3. 同步结束时按--stats统计的实际吞吐调整容量估计：
+           跑不满限额说明链路已拥塞，按实际吞吐下调；跑满时逐步恢复到配置值
+    """
+    _WEIGHTS = {False: 4, True: 1}
+    # 最低份额，占容量的比例
+    _MIN_SHARE = 1 / 16.0
+    # 估计的容量不低于配置值的该比例
+    _MIN_CAPACITY = 0.1
+    # 小于该字节数的同步不用于调整容量估计
+    _MIN_SAMPLE = 4 * 1024 * 1024
+    _ALPHA = 0.3
+    _capacity = 0
+    _bulk_share = 0.5
+    _links = {}
+    _lock = Lock()
+
+    @classmethod
+    def init(cls):
+        """ 可选项，每个对端的链路容量(KB/s)，0表示不限速，默认0；批量同步最多占用的比例，默认0.5 """
+        cls._capacity = float(ConfigWrapper.get_key_value('remote_bandwidth') or 0)
+        cls._bulk_share = float(ConfigWrapper.get_key_value('bulk_bandwidth_share') or 0.5)
+        cls._links = {}
+
+    @classmethod
+    def acquire(cls, ip, bulk):
+        """
+        为一次同步分配带宽
+
+        返回值：
+            --bwlimit值(KB/s)，0表示不限速
+        """
+        if not cls._capacity:
+            return 0
+        with cls._lock:
+            link = cls._links.get(ip)
+            if link is None:
+                link = cls._links[ip] = _Link(cls._capacity)
+            weight = cls._WEIGHTS[bulk]
+            fair = link.capacity * weight / (link.weight + weight)
+            # 剩余容量按两类同步的分配总和计算，否则两类可以各自分满整条链路
+            free = link.capacity - sum(link.reserved.values())
+            if bulk:
+                share = (link.capacity - link.reserved[False]) * cls._bulk_share
+                free = min(free, share - link.reserved[True])
+            # 分配和归还的都是返回给rsync的整数值，避免小数部分累积
+            limit = int(max(min(fair, free), link.capacity * cls._MIN_SHARE, 1))
+            link.weight += weight
+            link.reserved[bulk] += limit
+            return limit
+
+    @classmethod
+    def govern(cls, cmd, limit):
+        """ 加上限速和统计参数，用于计算实际吞吐 """
+        if not limit:
+            return cmd
+        return cmd[:1] + ['--bwlimit=%d' % limit, '--stats'] + cmd[1:]
+
+    @classmethod
+    def release(cls, ip, bulk, limit, out, cost):
+        """
+        归还分配的带宽，并按实际吞吐调整容量估计
+
+        参数：
+            out: rsync的输出，从中解析发送字节数
+            cost: 同步耗时(秒)
+        """
+        if not limit:
+            return
+        sent = _rsync_stat(out, 'Total bytes sent')
+        with cls._lock:
+            link = cls._links[ip]
+            link.weight -= cls._WEIGHTS[bulk]
+            link.reserved[bulk] -= limit
+            if sent < cls._MIN_SAMPLE or cost <= 0:
+                return
+            rate = sent / 1024.0 / cost
+            if rate < 0.8 * limit:
+                # 按该同步所占份额推算整条链路当前能达到的容量
+                estimate = rate * link.capacity / limit
+                link.capacity = max((1 - cls._ALPHA) * link.capacity + cls._ALPHA * estimate,
+                                    cls._capacity * cls._MIN_CAPACITY)
+            else:
+                link.capacity = min(link.capacity * 1.25, cls._capacity)
+
+    @classmethod
+    def status(cls):
+        return dict((ip, '%dKB/s' % link.capacity) for ip, link in cls._links.items())
+
+
+class _Remote(object):
+    __slots__ = ('rate', 'decisions', 'stats')
+
+    def __init__(self):
+        # 估计的链路吞吐(字节/秒)，未压缩的同步才能直接测得
+        self.rate = None
+        self.decisions = 0
+        # {压缩级别: [同步次数, 待传数据字节, 实际发送字节, 耗时]}
+        self.stats = {}
+
+
+class CompressAdvisor:
+    """
+    自适应压缩
+
+    rsync只压缩增量算法算出的待传数据(Literal data)，是否压缩按每字节耗时比较：
+        不压缩: 1 / 链路吞吐
+        级别L:  压缩率L / 链路吞吐 + 1 / 压缩速度L
+    其中：
+        1. 压缩率按扩展名统计，抽取文件头部用zlib试压缩，每种扩展名抽样若干个；
+           几乎压不动的扩展名用--skip-compress跳过，不参与比较；
+        2. 压缩速度是本机zlib的实测值，与rsync使用的算法一致；
+        3. 链路吞吐按对端统计，取自--stats的发送字节数和耗时；
+           压缩时测得的只是下限，因此定期不压缩同步一次，重新测量
+    """
+    _LEVELS = (1, 6)
+    # 每种扩展名的抽样文件数
+    _SAMPLES = 8
+    _SAMPLE_SIZE = 64 * 1024
+    # 每批任务最多检查的文件数，其中每个目录任务最多检查的文件数
+    _MAX_FILES = 256
+    _DIR_FILES = 32
+    # 压缩率高于该值的扩展名不压缩
+    _INCOMPRESSIBLE = 0.9
+    # 每多少次决策不压缩一次，重新测量链路吞吐
+    _EXPLORE = 20
+    # 小于该字节数的同步不用于估计链路吞吐
+    _MIN_SAMPLE = 1024 * 1024
+    _ALPHA = 0.3
+    # {扩展名: [抽样数, {压缩级别: 压缩率}]}
+    _ratios = {}
+    # {压缩级别: 压缩速度(字节/秒)}
+    _speeds = {}
+    _remotes = {}
+    _lock = Lock()
+
+    @classmethod
+    def init(cls):
+        cls._ratios = {}
+        cls._speeds = {}
+        cls._remotes = {}
+
+    @classmethod
+    def _ewma(cls, old, value):
+        return value if old is None else (1 - cls._ALPHA) * old + cls._ALPHA * value
+
+    @classmethod
+    def _sample(cls, ext, path):
+        """ 试压缩文件头部，更新扩展名的压缩率和本机压缩速度 """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(cls._SAMPLE_SIZE)
+        except (IOError, OSError):
+            return
+        if len(data) < 512:
+            return
+        result = {}
+        for level in cls._LEVELS:
+            start = time.time()
+            size = len(zlib.compress(data, level))
+            result[level] = (float(size) / len(data), len(data) / max(time.time() - start, 1e-6))
+        with cls._lock:
+            count, ratios = cls._ratios.setdefault(ext, [0, {}])
+            cls._ratios[ext][0] = count + 1
+            for level, (ratio, speed) in result.items():
+                ratios[level] = (ratios.get(level, ratio) * count + ratio) / (count + 1)
+                cls._speeds[level] = cls._ewma(cls._speeds.get(level), speed)
+
+    @classmethod
+    def profile(cls, task_list):
+        """
+        统计一批任务中各扩展名的字节数，抽样数不够的扩展名顺便抽样；
+        目录任务检查其下最多_DIR_FILES个文件
+
+        返回值：
+            {扩展名: 字节数}，没有找到文件时为空
+        """
+        mix = {}
+        files = []
+        for path in task_list:
+            if len(files) >= cls._MAX_FILES:
+                break
+            if not os.path.isdir(path) or os.path.islink(path):
+                files.append(path)
+                continue
+            count = 0
+            for root, dirs, names in os.walk(path):
+                for name in names[:cls._DIR_FILES - count]:
+                    files.append(os.path.join(root, name))
+                count += min(len(names), cls._DIR_FILES - count)
+                if count >= cls._DIR_FILES:
+                    break
+        for path in files[:cls._MAX_FILES]:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            ext = os.path.splitext(path)[1][1:].lower()
+            mix[ext] = mix.get(ext, 0) + st.st_size
+            if cls._ratios.get(ext, [0])[0] < cls._SAMPLES:
+                cls._sample(ext, path)
+        return mix
+
+    @classmethod
+    def decide(cls, ip, mix, fallback=0):
+        """
+        选择压缩级别
+
+        参数：
+            fallback: 还没有链路吞吐或压缩率数据时使用的压缩级别，
+                      即监听目录的compress配置
+
+        返回值：
+            压缩级别(0表示不压缩), 跳过压缩的扩展名列表, 决策原因
+        """
+        with cls._lock:
+            remote = cls._remotes.setdefault(ip, _Remote())
+            remote.decisions += 1
+            if remote.rate is None:
+                return fallback, [], 'measuring link'
+            if remote.decisions % cls._EXPLORE == 0:
+                return 0, [], 'explore'
+            skip, weights = [], {}
+            for ext, size in mix.items():
+                ratios = cls._ratios.get(ext, [0, {}])[1]
+                if ratios.get(cls._LEVELS[0], 0) > cls._INCOMPRESSIBLE:
+                    if ext:
+                        skip.append(ext)
+                elif ratios:
+                    weights[ext] = size
+            total = float(sum(weights.values()))
+            if not skip and (not total or len(cls._speeds) < len(cls._LEVELS)):
+                return fallback, [], 'no samples'
+            if not total:
+                return 0, skip, 'incompressible'
+            best, best_cost = 0, 1.0 / remote.rate
+            for level in cls._LEVELS:
+                ratio = sum(cls._ratios[ext][1][level] * size for ext, size in weights.items()) / total
+                cost = ratio / remote.rate + 1.0 / cls._speeds[level]
+                if cost < best_cost:
+                    best, best_cost = level, cost
+            return best, skip, 'link %dKB/s, %.2fus/B' % (remote.rate / 1024, best_cost * 1e6)
+
+    @classmethod
+    def apply(cls, ip, cmd, mix, fallback=0):
+        """ 按决策加上压缩和统计参数 """
+        level, skip, reason = cls.decide(ip, mix, fallback)
+        options = ['--compress-level=%d' % level, '--stats']
+        if level:
+            options.append('-z')
+            if skip:
+                options.append('--skip-compress=%s' % '/'.join(sorted(skip)))
+        Logger.debug("[fs_connect] compress %s level %s (%s)" % (ip, level, reason))
+        return cmd[:1] + options + cmd[1:]
+
+    @classmethod
+    def observe(cls, ip, cmd, out, cost):
+        """ 记录按决策执行的同步结果，更新对端链路吞吐 """
+        level = [int(arg.split('=', 1)[1]) for arg in cmd if arg.startswith('--compress-level=')]
+        if not level:
+            return
+        level = level[0]
+        literal = _rsync_stat(out, 'Literal data')
+        sent = _rsync_stat(out, 'Total bytes sent')
+        with cls._lock:
+            remote = cls._remotes.setdefault(ip, _Remote())
+            stats = remote.stats.setdefault(level, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += literal
+            stats[2] += sent
+            stats[3] += cost
+            if sent < cls._MIN_SAMPLE or cost <= 0:
+                return
+            rate = sent / cost
+            if level:
+                remote.rate = max(remote.rate or 0, rate)
+            else:
+                remote.rate = cls._ewma(remote.rate, rate)
+
+    @classmethod
+    def status(cls):
+        """ 各对端的链路吞吐，及按压缩级别统计的同步次数、实际发送/待传数据、耗时 """
+        result = {}
+        for ip, remote in cls._remotes.items():
+            stats = ['level%s: %s runs %.2f %.1fs' % (level, runs, float(sent) / literal if literal else 1, seconds)
+                     for level, (runs, literal, sent, seconds) in sorted(remote.stats.items())]
+            rate = '%dKB/s' % (remote.rate / 1024) if remote.rate else '-'
+            result[ip] = '%s, %s' % (rate, ', '.join(stats))
+        return result
@@ -4,13 +4,25 @@
 
 本模块包括的数据：
     1. 文件同步主配置文件数据
-    2. 待同步任务数据
-    3. 重传任务数据
-    4. 状态数据
+    2. inotify事件数据
+    3. 待同步任务数据
+    4. 重传任务数据
+    5. 全量同步文件清单
+    6. 状态数据
 """
+import os
+import stat
+import time
+import random
+import zlib
+import heapq
+import marshal
 import fs_global as Global
+from hashlib import md5
 from json import dumps
-from threading import Lock
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from threading import Lock, Condition
 from fs_util import Singleton, Common, ParserConfig
 from fs_logger import Logger
 
@@ -135,6 +147,9 @@ class ConfigData(Singleton):
         else:
             # 转换成json字符串格式，提高日志可读性；
             Logger.info('[fs_data] curr_config: %s' % dumps(self._curr_config, indent=4))
+            # 每次加载配置后重建监听目录索引
+            ListenIndex.build(ConfigWrapper.get_listen_path(),
+                              ConfigWrapper.get_listen_path(last=True))
             return True
 
     def reload(self):
@@ -290,107 +305,1202 @@ class ConfigData(Singleton):
         del listen_required
 
 
+class RsyncTemplate(object):
+    """
+    监听目录的rsync同步参数模板
+
+    每次加载配置文件时按监听目录编译一次，
+    工作线程同步时只需补充同步文件和对端目录
+    """
+
+    def __init__(self, listen, last, index=0):
+        _get_value = ConfigWrapper.get_key_value
+        self.listen = listen
+        self.last = last
+        # 模板编号，同一批次中各监听目录的files-from文件按编号区分
+        self.index = index
+        # 监听项可能是文件，此时以其所在目录为批量同步根目录
+        self.base = listen if Common.is_dir(listen) else Common.dirname(listen)
+        self.remote_mkdir = _get_value('make_remote_dir', last=last) == 'true'
+        self.remote_ips = _get_value('remote_ip', listen, last).split(',')
+        self.targets = dict((ip, '%s@%s' % (Global.G_RSYNC_USER, ip))
+                            for ip in self.remote_ips)
+        flags = '-a'
+        if _get_value('checksum', listen, last) == 'true':
+            flags += 'c'
+        # 自适应压缩时由CompressAdvisor按对端选择压缩级别
+        self.adaptive_compress = _get_value('adaptive_compress', listen, last) == 'true'
+        # 自适应压缩还没有数据时按compress配置，与rsync -z的默认级别一致
+        self.compress_level = 6 if _get_value('compress', listen, last) == 'true' else 0
+        if self.compress_level and not self.adaptive_compress:
+            flags += 'z'
+        # 不经过shell执行，每个过滤条件单独一个参数
+        exclude = _get_value('exclude', listen, last)
+        self.excludes = exclude.split(',') if exclude else []
+        options = ['--exclude=%s' % e for e in self.excludes]
+        # 单任务同步
+        self.single = [Global.G_RSYNC_TOOL, flags] + options + ['--delete']
+        # 大文件单独同步，原地写入并保留中断的部分，超时或断链后续传
+        self.large = self.single + ['--inplace', '--partial']
+        # 批量同步，files-from模式下-a不包含-r，需要显式指定
+        self.batch = [Global.G_RSYNC_TOOL, flags + 'r'] + options + \
+                     ['--delete', '--itemize-changes', '--from0']
+        # 批量删除，不递归，files-from中本地已不存在的路径在对端删除(非空目录需要--force)
+        self.delete = [Global.G_RSYNC_TOOL, flags] + options + \
+                      ['--delete-missing-args', '--force', '--from0']
+
+
+class ListenIndex:
+    """
+    监听目录索引
+
+    按路径分量组织的前缀树，每次加载配置文件时编译一次，整体替换；
+    监听目录的realpath在编译时解析并一起索引，查找时不再有系统调用，
+    查找代价与任务路径深度成正比，与监听目录个数无关
+    """
+    # 叶子标记，路径分量不会为空字符串
+    _LEAF = ''
+    _index = {}
+    _templates = {}
+
+    @classmethod
+    def _split(cls, path):
+        return [p for p in path.split('/') if p]
+
+    @classmethod
+    def build(cls, curr_listen, last_listen):
+        index, templates = {}, {}
+        for last, listen_list in [(False, curr_listen), (True, last_listen)]:
+            for listen in listen_list:
+                templates[(listen, last)] = RsyncTemplate(listen, last, len(templates))
+                for path in set([listen, Common.realpath(listen)]):
+                    node = index
+                    for name in cls._split(path):
+                        node = node.setdefault(name, {})
+                    node.setdefault(cls._LEAF, {}).setdefault(last, listen)
+        # 整体替换，查找线程无需加锁
+        cls._index, cls._templates = index, templates
+
+    @classmethod
+    def template(cls, listen, last):
+        """ 获取监听目录编译好的rsync参数模板 """
+        return cls._templates[(listen, last)]
+
+    @classmethod
+    def find(cls, task):
+        """
+        找到task所在的监听目录
+
+        当前配置优先，都取包含task的最深一个监听目录
+
+        返回值：
+            任务所在的监听目录;
+            是否是上一次的配置文件数据
+        """
+        _leaf = cls._LEAF
+        node = cls._index
+        curr = last = None
+        for name in cls._split(task) + [None]:
+            if _leaf in node:
+                curr = node[_leaf].get(False, curr)
+                last = node[_leaf].get(True, last)
+            node = node.get(name)
+            if node is None:
+                break
+        if curr:
+            return curr, False
+        if last:
+            return last, True
+        return None, None
+
+
+class EventQueue(object):
+    """
+    inotify事件通道
+
+    有界队列，生产者(Inotify)追加事件后唤醒消费者(Master)，
+    消费者一次取走全部积压事件，出队为O(1)；
+    队列满时丢弃新事件并置溢出标志，由消费者全量同步监听目录兜底
+    """
+
+    def __init__(self, limit_size=1000000):
+        self._queue = deque()
+        self._limit_size = limit_size
+        self._cond = Condition(Lock())
+        self._overflow = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def set_limit(self, limit_size):
+        self._limit_size = limit_size
+
+    def put(self, event):
+        return self.put_many((event,))
+
+    def put_many(self, events):
+        """ 批量追加事件，返回是否全部加入 """
+        with self._cond:
+            room = self._limit_size - len(self._queue)
+            if len(events) > room:
+                if not self._overflow:
+                    Logger.error("[fs_data] Event count >= %s, "
+                                 "drop events until drained !!" % self._limit_size)
+                self._overflow = True
+                events = events[:max(room, 0)]
+            if events:
+                self._queue.extend(events)
+                self._cond.notify()
+            return not self._overflow
+
+    def get_batch(self, timeout=None):
+        """
+        获取积压的全部事件
+
+        队列为空时阻塞等待，直到有事件到达或超时
+
+        返回值：
+            事件列表(deque);
+            本批次之前是否发生过溢出
+        """
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(timeout)
+            batch, self._queue = self._queue, deque()
+            overflow, self._overflow = self._overflow, False
+        return batch, overflow
+
+
+class SettleWheel(object):
+    """
+    路径静默时间轮
+
+    路径最后一次变化后静默quiet秒才放出，持续变化的路径(如正在追加的日志)
+    最晚在第一次变化后max_delay秒放出，避免每次写关闭都同步一次；
+    按tick划分时间槽，到期时间只会推后，推后时不从旧槽中删除，
+    到期检查时跳过已推后的路径；非空时间槽用小顶堆排序
+    """
+
+    def __init__(self, quiet, max_delay, tick=0.05):
+        self.quiet = quiet
+        self.max_delay = max(max_delay, quiet)
+        self.tick = tick
+        # {路径: [第一次变化时间, 所在时间槽]}
+        self._paths = {}
+        # {时间槽: [路径]}
+        self._slots = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._paths)
+
+    def touch(self, path, now):
+        """ 路径发生变化，推后其到期时间 """
+        entry = self._paths.get(path)
+        first = entry[0] if entry else now
+        slot = int((min(now + self.quiet, first + self.max_delay)) / self.tick) + 1
+        if entry is None:
+            self._paths[path] = [first, slot]
+        elif entry[1] == slot:
+            return
+        else:
+            entry[1] = slot
+        paths = self._slots.get(slot)
+        if paths is None:
+            paths = self._slots[slot] = []
+            heapq.heappush(self._heap, slot)
+        paths.append(path)
+
+    def timeout(self, now, default):
+        """ 距最近一个时间槽到期的时间，没有等待中的路径时返回default """
+        if not self._heap:
+            return default
+        return max(self._heap[0] * self.tick - now, 0)
+
+    def expire(self, now):
+        """ 取出已到期的路径，按到期顺序 """
+        current = now / self.tick
+        out = []
+        while self._heap and self._heap[0] <= current:
+            slot = heapq.heappop(self._heap)
+            for path in self._slots.pop(slot):
+                entry = self._paths.get(path)
+                if entry is not None and entry[1] == slot:
+                    del self._paths[path]
+                    out.append(path)
+        return out
+
+    def drain(self):
+        """ 取出全部等待中的路径 """
+        out = list(self._paths)
+        self._paths, self._slots, self._heap = {}, {}, []
+        return out
+
+
+class _TrieNode(object):
+    __slots__ = ('name', 'parent', 'children', 'task', 'is_root', 'queued_children')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        # 已入队的任务路径，None表示未入队
+        self.task = None
+        # 是否为监听目录(不同监听目录的配置不同，不能跨目录合并)
+        self.is_root = False
+        # 已入队的直接子节点个数
+        self.queued_children = 0
+
+
+class TaskTrie(object):
+    """
+    待同步任务路径前缀树
+
+    与TaskQueue中的任务保持一致，用于任务合并：
+        1. 祖先目录已在队列中的任务直接丢弃(rsync -a同步目录时已包含子路径)；
+        2. 目录入队时，剔除队列中该目录下的所有任务；
+        3. 同一目录下入队的子任务数达到fanout时，合并为该目录
+    合并不跨越监听目录边界。
+    """
+
+    def __init__(self, fanout=0):
+        self.fanout = fanout
+        self._root = _TrieNode('', None)
+
+    @classmethod
+    def _split(cls, path):
+        return [p for p in path.split('/') if p]
+
+    def _find(self, path, create=False):
+        node = self._root
+        for name in self._split(path):
+            child = node.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[name] = _TrieNode(name, node)
+            node = child
+        return node
+
+    def _prune(self, node):
+        """ 删除不再需要的空节点 """
+        while node.parent is not None and not node.children \
+                and node.task is None and not node.is_root:
+            del node.parent.children[node.name]
+            node = node.parent
+
+    def set_roots(self, roots):
+        """ 设置监听目录边界 """
+        for node in list(self._iter_nodes(self._root)):
+            if node.is_root:
+                node.is_root = False
+                self._prune(node)
+        for root in roots:
+            self._find(root, create=True).is_root = True
+
+    def _iter_nodes(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(list(node.children.values()))
+
+    def covered(self, path):
+        """ 任务本身或其(同一监听目录内的)祖先目录是否已入队 """
+        node = self._root
+        covered = False
+        for name in self._split(path):
+            node = node.children.get(name)
+            if node is None:
+                return covered
+            if node.is_root:
+                covered = False
+            if node.task is not None:
+                covered = True
+        return covered
+
+    def add(self, task):
+        """
+        任务入队
+
+        返回值：
+            被该任务覆盖、需要从队列中剔除的子任务列表
+        """
+        node = self._find(task, create=True)
+        node.task = task
+        if node.parent is not None:
+            node.parent.queued_children += 1
+        subsumed, cleared = [], []
+        stack = list(node.children.values())
+        while stack:
+            child = stack.pop()
+            # 子监听目录的配置不同，不能被上级目录覆盖
+            if child.is_root:
+                continue
+            if child.task is not None:
+                subsumed.append(child.task)
+                cleared.append(child)
+                child.task = None
+                child.parent.queued_children -= 1
+            stack.extend(list(child.children.values()))
+        [self._prune(child) for child in cleared]
+        return subsumed
+
+    def remove(self, task):
+        """ 任务出队 """
+        node = self._find(task)
+        if node is None or node.task is None:
+            return
+        node.task = None
+        if node.parent is not None:
+            node.parent.queued_children -= 1
+        self._prune(node)
+
+    def collapse(self, task):
+        """
+        判断是否需要把task及其兄弟任务合并为上级目录
+
+        返回值：
+            需要入队的上级目录，不需要合并时返回None
+        """
+        if not self.fanout:
+            return None
+        node = self._find(task)
+        if node is None or node.is_root or node.parent is None:
+            return None
+        parent = node.parent
+        if parent.queued_children < self.fanout:
+            return None
+        # 上级目录必须仍在监听目录内
+        inside = parent
+        while inside is not None and not inside.is_root:
+            inside = inside.parent
+        if inside is None:
+            return None
+        names = []
+        while parent.parent is not None:
+            names.append(parent.name)
+            parent = parent.parent
+        return '/' + '/'.join(reversed(names))
+
+
+class FifoScheduler(object):
+    """
+    先进先出调度
+
+    所有任务一个队列，按积压量粗分批次，不区分监听目录
+    """
+
+    def __init__(self, thread_count):
+        self._queue = OrderedDict()
+        self._thread_count = thread_count
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def push(self, task, size):
+        self._queue[task] = None
+
+    def remove(self, task):
+        del self._queue[task]
+
+    def _batch_size(self, _len):
+        if _len > 100:
+            return int(_len / self._thread_count)
+        elif 50 <= _len < 100:
+            return 15
+        elif 10 <= _len < 50:
+            return 8
+        return _len
+
+    def pop_batch(self):
+        _popitem = self._queue.popitem
+        return [_popitem(last=False)[0] for _ in range(self._batch_size(len(self._queue)))]
+
+    def feedback(self, section, count, cost):
+        pass
+
+
+class DrrScheduler(object):
+    """
+    按监听目录公平调度(Deficit Round Robin)
+
+    每个监听目录一个子队列，有任务的目录轮流被服务；
+    额度按预计同步耗时(秒)计：每轮给目录增加 batch_target*weight 的额度，
+    一次取出额度内能同步完的任务，繁忙目录无法挤占其他目录；
+    单任务耗时取该目录已完成批次的平均耗时(EWMA)，
+    因此批次大小随实际rsync耗时自适应，大文件目录批次小，小文件目录批次大；
+    目录内按文件大小分档，先出小文件(近似短作业优先)，档内先进先出
+    """
+    # 尚无观测数据时的单任务耗时估计(秒)
+    _DEFAULT_COST = 0.1
+    # 单任务耗时下限，避免批次无限大
+    _MIN_COST = 0.001
+    # 单批次任务数上限
+    _MAX_BATCH = 1000
+    # EWMA平滑系数
+    _ALPHA = 0.3
+    # 文件大小分档上界(字节)，超过最后一档的文件为一档，目录为最后一档
+    _SIZE_CLASSES = (64 * 1024, 1024 * 1024)
+
+    def __init__(self, batch_target=2.0):
+        self._batch_target = batch_target
+        # {(监听目录, 是否是上一次的配置): [按大小分档的OrderedDict(任务)]}
+        self._queues = {}
+        # {子队列: 任务数}
+        self._counts = {}
+        # {任务: (所在子队列, 大小档位)}
+        self._sections = {}
+        # 有任务的子队列，轮转顺序
+        self._active = deque()
+        self._deficit = {}
+        # {子队列: 单任务平均耗时}
+        self._cost = {}
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    @classmethod
+    def _weight(cls, section):
+        listen, last = section
+        try:
+            weight = float(ConfigWrapper.get_key_value('weight', listen, last) or 1)
+        except ValueError:
+            weight = 1.0
+        return weight if weight > 0 else 1.0
+
+    def push(self, task, size):
+        section = ListenIndex.find(task)
+        queues = self._queues.get(section)
+        if queues is None:
+            queues = self._queues[section] = [OrderedDict()
+                                              for _ in range(len(self._SIZE_CLASSES) + 2)]
+            self._counts[section] = 0
+            self._active.append(section)
+            self._deficit[section] = 0.0
+        level = len(queues) - 1 if size is None else bisect_right(self._SIZE_CLASSES, size)
+        queues[level][task] = None
+        self._counts[section] += 1
+        self._sections[task] = (section, level)
+
+    def _drop(self, section):
+        """ 子队列为空时退出轮转，额度清零 """
+        del self._queues[section]
+        del self._counts[section]
+        del self._deficit[section]
+        self._active.remove(section)
+
+    def remove(self, task):
+        section, level = self._sections.pop(task)
+        del self._queues[section][level][task]
+        self._counts[section] -= 1
+        if not self._counts[section]:
+            self._drop(section)
+
+    def pop_batch(self):
+        _active = self._active
+        while _active:
+            section = _active[0]
+            _active.rotate(-1)
+            cost = max(self._cost.get(section, self._DEFAULT_COST), self._MIN_COST)
+            deficit = self._deficit[section] + self._batch_target * self._weight(section)
+            count = min(int(deficit / cost), self._counts[section], self._MAX_BATCH)
+            if count < 1:
+                # 额度不足一个任务，留到下一轮
+                self._deficit[section] = deficit
+                continue
+            out_task = []
+            for queue in self._queues[section]:
+                _popitem = queue.popitem
+                while queue and len(out_task) < count:
+                    out_task.append(_popitem(last=False)[0])
+            [self._sections.pop(task) for task in out_task]
+            self._counts[section] -= count
+            if self._counts[section]:
+                # 剩余额度不超过一轮，避免长时间受限的目录积攒突发
+                self._deficit[section] = min(deficit - count * cost,
+                                             self._batch_target * self._weight(section))
+            else:
+                self._drop(section)
+            return out_task
+        return []
+
+    def feedback(self, section, count, cost):
+        if count < 1:
+            return
+        avg = float(cost) / count
+        prev = self._cost.get(section)
+        self._cost[section] = avg if prev is None else \
+            self._ALPHA * avg + (1 - self._ALPHA) * prev
+
+
+class TaskJournal(object):
+    """
+    任务预写日志
+
+    只追加写的磁盘日志，记录任务入队(+)以及同步完成或被合并(-)，
+    同一路径可能既在队列中又在同步中，因此按次数抵消；
+    重启时重放日志得到未完成的任务，只重新同步这些路径；
+    记录先写入内存缓冲，由刷盘线程周期性批量写入并fsync(组提交)，
+    崩溃时最多丢失一个刷盘周期内的记录；
+    日志中已抵消的记录过多时，按未完成的任务重写日志(压缩)
+    """
+    _ADD = b'+'
+    _DONE = b'-'
+    # 记录之间以NUL分隔，路径中不会出现NUL
+    _SEP = b'\0'
+    # 日志记录数超过未完成任务数的该倍数时压缩
+    _COMPACT_RATIO = 4
+    _COMPACT_MIN = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._buffer = []
+        # {任务: 未完成次数}
+        self._live = {}
+        # {任务: 次数}，重放的任务重新入队时不再记录，已在重写的日志中
+        self._replayed = {}
+        self._records = 0
+        self._fd = None
+
+    @classmethod
+    def _encode(cls, task):
+        return task if isinstance(task, bytes) else task.encode('utf-8', 'surrogateescape')
+
+    @classmethod
+    def _decode(cls, record):
+        return record if str is bytes else record.decode('utf-8', 'surrogateescape')
+
+    def replay(self):
+        """
+        读取上次退出时的日志，按未完成的任务重写日志后开始追加记录；
+        先落盘再追加，重放的任务重新入队前退出也不会丢失
+
+        返回值：
+            未完成的任务列表(按首次入队顺序)，日志不存在时返回None
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            data = None
+        live = OrderedDict()
+        # 最后一段没有分隔符，是写了一半的记录，丢弃
+        for record in (data or b'').split(self._SEP)[:-1]:
+            op, task = record[:1], self._decode(record[1:])
+            count = live.get(task, 0) + (1 if op == self._ADD else -1)
+            if count > 0:
+                live[task] = count
+            else:
+                live.pop(task, None)
+        snapshot = list(live.items())
+        with self._lock:
+            self._live = dict(snapshot)
+            self._replayed = dict(snapshot)
+        self._rewrite(snapshot)
+        if data is None:
+            return None
+        Logger.info("[fs_data] replay %s: %s tasks unfinished" % (self.path, len(live)))
+        return list(live)
+
+    def add(self, task):
+        with self._lock:
+            count = self._replayed.get(task)
+            if count:
+                if count > 1:
+                    self._replayed[task] = count - 1
+                else:
+                    del self._replayed[task]
+                return
+            self._live[task] = self._live.get(task, 0) + 1
+            self._buffer.append(self._ADD + self._encode(task) + self._SEP)
+
+    def settle(self):
+        """ 重放的任务重新入队后调用，没有重新入队(被其他任务覆盖等)的记为完成 """
+        with self._lock:
+            remain, self._replayed = self._replayed, {}
+        self.done([task for task, count in remain.items() for _ in range(count)])
+
+    def done(self, task_list):
+        with self._lock:
+            _live = self._live
+            for task in task_list:
+                count = _live.get(task, 0) - 1
+                if count > 0:
+                    _live[task] = count
+                else:
+                    _live.pop(task, None)
+                self._buffer.append(self._DONE + self._encode(task) + self._SEP)
+
+    def flush(self, args=None):
+        """ 刷盘，缓冲中的记录一次写入并fsync """
+        with self._flush_lock:
+            if self._fd is None:
+                return
+            with self._lock:
+                if not self._buffer:
+                    return
+                buf, self._buffer = self._buffer, []
+                self._records += len(buf)
+                # 压缩用的快照与本次写入的记录对应，之后的记录写入新日志
+                snapshot = None
+                if self._records > max(self._COMPACT_MIN, self._COMPACT_RATIO * len(self._live)):
+                    snapshot = list(self._live.items())
+            try:
+                os.write(self._fd, b''.join(buf))
+                os.fsync(self._fd)
+                if snapshot is not None:
+                    self._compact(snapshot)
+            except OSError as e:
+                Logger.error("[fs_data] write journal %s failed: %s" % (self.path, e))
+
+    def _rewrite(self, snapshot):
+        """ 按未完成的任务写入临时文件后替换日志，之后在新日志上追加 """
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, b''.join(self._ADD + self._encode(task) + self._SEP
+                                  for task, count in snapshot for _ in range(count)))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.path)
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._records = len(snapshot)
+
+    def _compact(self, snapshot):
+        self._rewrite(snapshot)
+        Logger.debug("[fs_data] compact journal %s: %s tasks" % (self.path, len(snapshot)))
+
+    def close(self):
+        self.flush()
+        with self._flush_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
 class TaskQueue:
-    """ 任务队列 """
-    _task_queue = None
+    """
+    任务队列
+
+    按入队时的文件大小分两条通道：
+        1. 普通通道：入队时经TaskTrie合并被覆盖的任务，
+           任务存放及出队顺序由调度器(DrrScheduler/FifoScheduler)决定，
+           工作线程通过request阻塞获取一批任务；
+        2. 大文件通道：先进先出，由单独的大文件工作线程通过request_large逐个获取，
+           大文件同步不会占住普通工作线程；大文件不参与合并，
+           既不被所在目录的任务吸收，也不会随兄弟任务合并为上级目录
+    """
+    _scheduler = FifoScheduler(1)
+    _large_queue = OrderedDict()
+    # 大文件阈值(字节)，0表示不区分大文件
+    _large_size = 0
+    _task_trie = TaskTrie()
     _limit_size = None
-    _thread_count = None
+    _journal = None
     _lock = Lock()
+    _cond = Condition(_lock)
+    _large_cond = Condition(_lock)
 
     @classmethod
-    def init(cls, limit_size, thread_count):
-        cls._task_queue = []
+    def init(cls, limit_size, thread_count, fanout=0, scheduler=None, large_size=0):
+        """ scheduler为None时使用先进先出调度 """
+        cls._scheduler = FifoScheduler(thread_count) if scheduler is None else scheduler
+        cls._large_queue = OrderedDict()
+        cls._large_size = large_size
+        cls._task_trie = TaskTrie(fanout)
         cls._limit_size = limit_size
-        cls._thread_count = thread_count
+        cls.set_listen()
+
+    @classmethod
+    def has_large_lane(cls):
+        return cls._large_size > 0
+
+    @classmethod
+    def set_journal(cls, journal):
+        cls._journal = journal
+
+    @classmethod
+    def done(cls, task_list):
+        """ 工作线程处理完一批任务后调用，记录到预写日志 """
+        if cls._journal:
+            cls._journal.done(task_list)
+
+    @classmethod
+    def set_listen(cls):
+        """ 更新合并边界(监听目录)，reload后调用 """
+        with cls._cond:
+            cls._task_trie.set_roots(ConfigWrapper.get_listen_path())
 
     @classmethod
     def status(cls):
-        return cls._task_queue
+        with cls._lock:
+            return list(cls._scheduler) + list(cls._large_queue)
 
     @classmethod
-    def push_task(cls, task):
-        """ list.append为原子操作，不需要加锁 """
-        if task in cls._task_queue:
-            return
+    def _is_full(cls):
         """ 检查队列大小 """
-        length_task = len(cls._task_queue)
+        length_task = len(cls._scheduler) + len(cls._large_queue)
         half_limit = cls._limit_size / 2
-        if length_task > half_limit:
-            Logger.warn("[fs_data] Task count > %s !!" % half_limit)
-        elif length_task >= cls._limit_size:
+        if length_task >= cls._limit_size:
             Logger.error("[fs_data] Task count >= %s, "
                          "can't append task anymore !!" % cls._limit_size)
-            return
-        cls._task_queue.append(task)
+            return True
+        elif length_task > half_limit:
+            Logger.warn("[fs_data] Task count > %s !!" % half_limit)
+        return False
+
+    @classmethod
+    def push_task(cls, task):
+        # 入队前取文件大小，不在锁内做系统调用
+        size = Common.file_size(task)
+        with cls._lock:
+            _trie = cls._task_trie
+            _scheduler = cls._scheduler
+            _journal = cls._journal
+            if size and 0 < cls._large_size <= size:
+                # 大文件只进入大文件通道，不加入TaskTrie
+                if task in cls._large_queue or cls._is_full():
+                    return
+                cls._large_queue[task] = None
+                if _journal:
+                    _journal.add(task)
+                cls._large_cond.notify()
+                return
+            while task:
+                # 任务本身或祖先目录已在队列中
+                if _trie.covered(task) or cls._is_full():
+                    break
+                subs = _trie.add(task)
+                for sub in subs:
+                    Logger.debug("[fs_data] %s covered by %s" % (sub, task))
+                    _scheduler.remove(sub)
+                if _journal:
+                    _journal.done(subs)
+                    _journal.add(task)
+                _scheduler.push(task, size)
+                cls._cond.notify()
+                # 兄弟任务过多时合并为上级目录，合并后的任务是目录
+                task, size = _trie.collapse(task), None
+
+    @classmethod
+    def request(cls, timeout=None):
+        """
+        工作线程获取任务
+
+        队列为空时阻塞等待，直到有任务入队或超时；
+        由调度器决定本批次的任务
+
+        参数：
+            timeout: 最长等待时间(秒)，None表示一直等待
+
+        返回值：
+            任务列表，超时返回空列表
+        """
+        with cls._cond:
+            if not len(cls._scheduler):
+                cls._cond.wait(timeout)
+            _len = len(cls._scheduler)
+            if _len == 0:
+                return []
+            Logger.debug("[fs_data] Task count=%s" % _len)
+            out_task = cls._scheduler.pop_batch()
+            [cls._task_trie.remove(task) for task in out_task]
+            return out_task
+
+    @classmethod
+    def request_large(cls, timeout=None):
+        """
+        大文件工作线程获取任务
+
+        每次只取一个大文件，队列为空时阻塞等待，直到有大文件入队或超时
+
+        返回值：
+            任务列表，超时返回空列表
+        """
+        with cls._large_cond:
+            if not cls._large_queue:
+                cls._large_cond.wait(timeout)
+            if not cls._large_queue:
+                return []
+            return [cls._large_queue.popitem(last=False)[0]]
 
     @classmethod
     def request_tesk(cls):
-        """ 工作线程获取任务，加锁 """
-        cls._lock.acquire()
-        _len = len(cls._task_queue)
-        if _len == 0:
-            cls._lock.release()
-            return
-        Logger.debug("[fs_data] Task count=%s" % _len)
-        # TODO 这个分配机制太简陋，待优化
-        if _len > 100:
-            index = int(_len/cls._thread_count)
-        elif 50 <= _len < 100:
-            index = 15
-        elif 10 <= _len < 50:
-            index = 8
-        else:
-            index = _len
+        """ 非阻塞获取任务 """
+        return cls.request(timeout=0)
 
-        out_task = cls._task_queue[:index]
-        cls._task_queue = cls._task_queue[index:]
+    @classmethod
+    def feedback(cls, section, count, cost):
+        """
+        上报一个批次的同步耗时，用于调整该监听目录的批次大小
 
-        # 释放锁
-        cls._lock.release()
-        return out_task
+        参数：
+            section: (监听目录, 是否是上一次的配置)
+            count: 批次任务数
+            cost: 同步耗时(秒)，多个对端时取最长的一个
+        """
+        with cls._lock:
+            cls._scheduler.feedback(section, count, cost)
 
 
 class RetryQueue:
-    """ 失败重传队列 """
-    _task_queue = []
+    """
+    失败重传队列
+
+    每个任务记录连续失败次数，下次重传时间按指数退避并加随机抖动，
+    避免对端故障期间反复重传；超过最大重传次数后放弃，由下次全量同步兜底；
+    任务只重传到失败或熔断的对端，不再重复同步到已成功的对端
+    """
+    # {任务: (已重传次数, 下次重传时间, 待重传的对端集合)}，对端集合为None表示全部对端
+    _task_queue = OrderedDict()
+    # {任务: 已重传次数}，正在重传的任务
+    _inflight = {}
+    _limit_size = None
+    _base_delay = 10
+    _max_delay = 600
+    _max_attempts = 10
+    _journal = None
+    _lock = Lock()
+
+    @classmethod
+    def init(cls, limit_size, base_delay=10, max_delay=600, max_attempts=10):
+        cls._limit_size = limit_size
+        cls._base_delay = base_delay
+        cls._max_delay = max_delay
+        cls._max_attempts = max_attempts
+
+    @classmethod
+    def set_journal(cls, journal):
+        cls._journal = journal
+
+    @classmethod
+    def done(cls, task_list):
+        """ 重传线程处理完一批任务后调用 """
+        with cls._lock:
+            [cls._inflight.pop(task, None) for task in task_list]
+        if cls._journal:
+            cls._journal.done(task_list)
+
+    @classmethod
+    def status(cls):
+        return list(cls._task_queue)
+
+    @classmethod
+    def _backoff(cls, attempts):
+        delay = min(cls._max_delay, cls._base_delay * 2 ** attempts)
+        # 一半固定一半随机，同一时刻失败的任务错开重传
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    @classmethod
+    def push_task(cls, task, failed=True, ip=None, due=None):
+        """
+        参数：
+            failed: 是否是同步失败，对端熔断未同步时为False，不计重传次数
+            ip: 只重传到该对端，None表示全部对端
+            due: 重传时间，默认按重传次数退避
+        """
+        with cls._lock:
+            attempts = cls._inflight.get(task, -1 if failed else 0)
+            if failed:
+                attempts += 1
+            if attempts >= cls._max_attempts:
+                Logger.error("[fs_data] %s failed %s times, give up retrying" % (task, attempts))
+                SyncManifest.forget(task)
+                return
+            if due is None:
+                due = time.time() + cls._backoff(attempts)
+            ips = None if ip is None else frozenset([ip])
+            queued = cls._task_queue.get(task)
+            if queued is not None:
+                # 已在队列中时合并待重传的对端，取较早的重传时间
+                _attempts, _due, _ips = queued
+                ips = None if ips is None or _ips is None else ips | _ips
+                cls._task_queue[task] = (max(attempts, _attempts), min(due, _due), ips)
+                return
+            """ 检查队列大小 """
+            length_task = len(cls._task_queue)
+            half_limit = cls._limit_size / 2
+            if length_task >= cls._limit_size:
+                Logger.error("[fs_data] Task count >= %s, "
+                             "can't append task anymore !!" % cls._limit_size)
+                return
+            elif length_task > half_limit:
+                Logger.warn("[fs_data] Task count > %s !!" % half_limit)
+            cls._task_queue[task] = (attempts, due, ips)
+            if cls._journal:
+                cls._journal.add(task)
+
+    @classmethod
+    def request_task(cls):
+        """
+        取出已到重传时间的任务
+
+        返回值：
+            [(任务, 待重传的对端集合)]
+        """
+        with cls._lock:
+            now = time.time()
+            out_task = [(task, ips) for task, (_, due, ips) in cls._task_queue.items() if due <= now]
+            for task, _ in out_task:
+                cls._inflight[task] = cls._task_queue.pop(task)[0]
+        return out_task
+
+
+class DeleteQueue:
+    """
+    删除任务队列
+
+    已删除或移走的路径不再按其所在目录同步(rsync --delete要比较整个目录)，
+    由删除线程一次取走积压的全部路径，按监听目录成批在对端删除
+    """
+    _task_queue = OrderedDict()
     _limit_size = None
+    _journal = None
+    _cond = Condition(Lock())
 
     @classmethod
     def init(cls, limit_size):
         cls._limit_size = limit_size
 
+    @classmethod
+    def set_journal(cls, journal):
+        cls._journal = journal
+
+    @classmethod
+    def done(cls, task_list):
+        """ 删除线程处理完一批任务后调用 """
+        if cls._journal:
+            cls._journal.done(task_list)
+
     @classmethod
     def status(cls):
-        return cls._task_queue
+        return list(cls._task_queue)
 
     @classmethod
     def push_task(cls, task):
-        if task in cls._task_queue:
-            return
-        """ 检查队列大小 """
-        length_task = len(cls._task_queue)
-        half_limit = cls._limit_size / 2
-        if length_task > half_limit:
-            Logger.warn("[fs_data] Task count > %s !!" % half_limit)
-        elif length_task >= cls._limit_size:
-            Logger.error("[fs_data] Task count >= %s, "
-                         "can't append task anymore !!" % cls._limit_size)
-            return
-        cls._task_queue.append(task)
+        """
+        返回值：
+            是否加入队列，队列已满时返回False，由调用者按所在目录同步
+        """
+        with cls._cond:
+            if task in cls._task_queue:
+                return True
+            if len(cls._task_queue) >= cls._limit_size:
+                return False
+            cls._task_queue[task] = None
+            if cls._journal:
+                cls._journal.add(task)
+            cls._cond.notify()
+            return True
 
     @classmethod
-    def request_task(cls):
-        out_task = cls._task_queue[:]
-        cls._task_queue = []
+    def request_task(cls, timeout=None):
+        """ 取出积压的全部路径，队列为空时最多等待timeout秒 """
+        with cls._cond:
+            if not cls._task_queue:
+                cls._cond.wait(timeout)
+            out_task, cls._task_queue = list(cls._task_queue), OrderedDict()
         return out_task
 
 
+class RemoteDirCache:
+    """
+    对端已存在目录缓存
+
+    make_remote_dir开启时，记录每个对端IP上已确认存在的目录，
+    已存在的目录不再登录对端创建；按LRU淘汰，
+    本地目录删除或同步失败时失效
+    """
+    _dirs = {}
+    _limit_size = 10000
+    _lock = Lock()
+
+    @classmethod
+    def init(cls, limit_size):
+        with cls._lock:
+            cls._dirs = {}
+            cls._limit_size = limit_size
+
+    @classmethod
+    def missing(cls, ip, dirs):
+        """ 返回dirs中未确认存在的目录，命中的目录刷新LRU顺序 """
+        with cls._lock:
+            cache = cls._dirs.get(ip)
+            if cache is None:
+                return list(dirs)
+            out_dirs = []
+            for _dir in dirs:
+                if _dir in cache:
+                    cache[_dir] = cache.pop(_dir)
+                else:
+                    out_dirs.append(_dir)
+            return out_dirs
+
+    @classmethod
+    def add(cls, ip, dirs):
+        with cls._lock:
+            cache = cls._dirs.setdefault(ip, OrderedDict())
+            for _dir in dirs:
+                cache.pop(_dir, None)
+                cache[_dir] = None
+            while len(cache) > cls._limit_size:
+                cache.popitem(last=False)
+
+    @classmethod
+    def discard(cls, ip, _dir):
+        """ 同步失败时，该目录在对端可能已不存在 """
+        with cls._lock:
+            cache = cls._dirs.get(ip)
+            if cache is not None:
+                cache.pop(_dir, None)
+
+    @classmethod
+    def invalidate(cls, path):
+        """ 本地目录被删除或移走后，所有对端上该目录及其子目录失效 """
+        prefix = path.rstrip('/') + '/'
+        with cls._lock:
+            for cache in cls._dirs.values():
+                for _dir in [d for d in cache
+                             if d == path or d.startswith(prefix)]:
+                    del cache[_dir]
+
+
+class SyncManifest(object):
+    """
+    全量同步的本地文件清单
+
+    每个监听目录一个清单文件，记录上次全量同步时各路径的(inode, 大小, mtime)，
+    全量同步时只遍历stat监听目录并与清单比较，只同步有变化的文件和目录，
+    不再由rsync读取并校验全部文件；
+    同步最终失败的路径记为脏路径，下次全量同步时视为有变化
+    """
+    # 目录的大小字段，只比较inode，目录下的增删由子路径体现
+    _DIR = -1
+    _dirty = set()
+    _lock = Lock()
+
+    def __init__(self, listen):
+        self.listen = listen
+        name = md5(listen.encode('utf-8')).hexdigest()
+        self.path = Common.join_path(Global.G_RUN_DIR, 'manifest.%s' % name)
+
+    @classmethod
+    def forget(cls, path):
+        """ 同步最终失败，下次全量同步时重新同步 """
+        with cls._lock:
+            cls._dirty.add(path)
+
+    def load(self):
+        """ 读取清单，不存在或损坏时返回None """
+        try:
+            with open(self.path, 'rb') as f:
+                return marshal.loads(zlib.decompress(f.read()))
+        except (IOError, OSError, ValueError, EOFError, TypeError, zlib.error):
+            return None
+
+    def save(self, entries):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(marshal.dumps(entries)))
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            Logger.error("[fs_data] save manifest of %s failed: %s" % (self.listen, e))
+
+    @classmethod
+    def _key(cls, st):
+        if stat.S_ISDIR(st.st_mode):
+            return st.st_ino, cls._DIR, 0
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def scan(self):
+        """ 遍历监听目录，返回{路径: (inode, 大小, mtime)} """
+        entries = {}
+        _key, _lstat, _join = self._key, os.lstat, os.path.join
+        try:
+            entries[self.listen] = _key(_lstat(self.listen))
+        except OSError:
+            return entries
+        for root, dirs, files in os.walk(self.listen):
+            for name in dirs + files:
+                path = _join(root, name)
+                try:
+                    entries[path] = _key(_lstat(path))
+                except OSError:
+                    # 遍历过程中被删除
+                    continue
+        return entries
+
+    def _take_dirty(self, entries):
+        """ 清单中剔除脏路径及其子路径 """
+        with self._lock:
+            dirty = [p for p in self._dirty if Common.is_contain(self.listen, p)]
+            self._dirty.difference_update(dirty)
+        if not dirty:
+            return
+        prefixes = tuple(p.rstrip('/') + '/' for p in dirty)
+        for path in [p for p in entries if p in dirty or p.startswith(prefixes)]:
+            del entries[path]
+
+    def diff(self):
+        """
+        扫描监听目录并与清单比较
+
+        新增或修改的路径需要同步；被删除的路径在对端逐个删除，
+        不同步其所在目录(会比较所在目录下的全部内容)；
+        被其他待同步目录包含的路径不再单独同步
+
+        返回值：
+            待同步路径列表，没有清单时返回None;
+            已删除的最上层路径列表;
+            本次扫描结果，用于保存为新清单
+        """
+        entries = self.scan()
+        old = self.load()
+        if old is None:
+            return None, [], entries
+        if not entries:
+            # 监听目录不存在
+            return [], [], entries
+        self._take_dirty(old)
+        _pop = old.pop
+        changed = [path for path, key in entries.items() if _pop(path, None) != key]
+        _dirname = Common.dirname
+        # 剩下的是已删除的路径，只保留最上层的
+        deleted = sorted(p for p in old if _dirname(p) not in old)
+
+        dirs = set(p for p in changed if p not in entries or entries[p][1] == self._DIR)
+        task_list = []
+        for path in set(changed):
+            parent = _dirname(path)
+            while parent not in dirs and _dirname(parent) != parent:
+                parent = _dirname(parent)
+            if parent not in dirs:
+                task_list.append(path)
+        return task_list, deleted, entries
+
+
 class StateInfo:
     _inotify_pid = None
     _connected_ip = None
+    _remote_probe = None
+    _compress = None
     _syncing_task = None
     _waiting_task = None
     _retry_task = None
+    _delete_task = None
 
     @classmethod
     def set_inotify_pid(cls, pid):
@@ -400,6 +1510,14 @@ class StateInfo:
     def set_connected_ip(cls, ip_list):
         cls._connected_ip = ip_list
 
+    @classmethod
+    def set_remote_probe(cls, probe):
+        cls._remote_probe = probe
+
+    @classmethod
+    def set_compress(cls, compress):
+        cls._compress = compress
+
     @classmethod
     def set_syncing_task(cls, task_list):
         cls._syncing_task = task_list
@@ -412,6 +1530,10 @@ class StateInfo:
     def set_retry_task(cls, task_list):
         cls._retry_task = task_list
 
+    @classmethod
+    def set_delete_task(cls, task_list):
+        cls._delete_task = task_list
+
     @classmethod
     def get_state_info(cls):
         status_info = """
@@ -423,22 +1545,30 @@ class StateInfo:
         syncing: %s
         waiting: %s
           retry: %s
+         delete: %s
         
         [TASK-LIST]
         syncing: %s
           retry: %s
+         delete: %s
 
         [OTHERS]
         connected-ip: %s
+        remote-probe: %s
+            compress: %s
         missing-path: %s
         """ % (Common.get_pid(),
                cls._inotify_pid,
                len(cls._syncing_task) if cls._syncing_task else 0,
                len(cls._waiting_task) if cls._waiting_task else 0,
                len(cls._retry_task) if cls._retry_task else 0,
+               len(cls._delete_task) if cls._delete_task else 0,
                cls._syncing_task,
                cls._retry_task,
+               cls._delete_task,
                cls._connected_ip,
+               cls._remote_probe,
+               cls._compress,
                list(Global.G_MISS_LISTEN))
         return status_info
 
@@ -1,33 +1,343 @@
 # -*- coding: UTF-8 -*-
 """
-Inotifywait事件监听模块
+Inotify事件监听模块
 
 本模块功能：
-    1. inotifywait进程的创建，该进程持续监听配置文件中指定
-        文件或目录的变化事件（写关闭、修改、删除、移动、修改权限等）；
-    2. 把收集的事件发送出去由其他（Master）模块处理。
+    1. 监听配置文件中指定文件或目录的变化事件（写关闭、修改、删除、移动、修改权限等），
+        支持两种监听方式：
+        native:  进程内直接调用内核inotify接口，批量读取原始事件并用struct解码(默认)；
+        process: 创建inotifywait子进程，逐行读取其输出(native不可用时的兜底方式)；
+    2. native方式按cookie把MOVED_FROM和MOVED_TO配对成一个MOVE_PAIR事件；
+    3. 把收集的事件发送出去由其他（Master）模块处理。
 """
+import os
+import sys
+import time
+import errno
+import select
+import struct
 import subprocess
 from json import dumps
 import fs_global as Global
 from fs_util import FileOP, Common, Singleton
 from fs_logger import Logger
-from fs_data import ConfigWrapper, StateInfo
+from fs_data import ConfigWrapper, StateInfo, EventQueue
 from fs_message import Receiver
+from collections import OrderedDict
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+
+# 内核inotify事件掩码，见<sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_CLOSE = IN_CLOSE_WRITE | IN_CLOSE_NOWRITE
+IN_MOVE = IN_MOVED_FROM | IN_MOVED_TO
+
+# 与inotifywait输出(%e)保持一致的事件名称及顺序
+_EVENT_NAMES = ((IN_ACCESS, 'ACCESS'),
+                (IN_MODIFY, 'MODIFY'),
+                (IN_ATTRIB, 'ATTRIB'),
+                (IN_CLOSE_WRITE, 'CLOSE_WRITE'),
+                (IN_CLOSE_NOWRITE, 'CLOSE_NOWRITE'),
+                (IN_OPEN, 'OPEN'),
+                (IN_MOVED_FROM, 'MOVED_FROM'),
+                (IN_MOVED_TO, 'MOVED_TO'),
+                (IN_CREATE, 'CREATE'),
+                (IN_DELETE, 'DELETE'),
+                (IN_DELETE_SELF, 'DELETE_SELF'),
+                (IN_UNMOUNT, 'UNMOUNT'),
+                (IN_Q_OVERFLOW, 'Q_OVERFLOW'),
+                (IN_IGNORED, 'IGNORED'),
+                (IN_CLOSE, 'CLOSE'),
+                (IN_MOVE_SELF, 'MOVE_SELF'),
+                (IN_ISDIR, 'ISDIR'))
+
+# 配置项与inotifywait事件参数、事件掩码的对应关系
+_CONFIG_MASKS = (('event_delete', 'delete', IN_DELETE),
+                 ('event_create', 'create', IN_CREATE),
+                 ('event_closewrite', 'close_write', IN_CLOSE_WRITE),
+                 ('event_move', 'move', IN_MOVE),
+                 ('event_movedto', 'moved_to', IN_MOVED_TO),
+                 ('event_movedfrom', 'moved_from', IN_MOVED_FROM),
+                 ('event_attrib', 'attrib', IN_ATTRIB))
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_STRUCT = struct.Struct('iIII')
+_EVENT_SIZE = _EVENT_STRUCT.size
+
+
+def _fs_encode(path):
+    if sys.version_info[0] == 2:
+        return path
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def _fs_decode(raw):
+    if sys.version_info[0] == 2:
+        return raw
+    return raw.decode('utf-8', 'surrogateescape')
+
+
+def _mask_to_name(mask):
+    return ','.join([name for bit, name in _EVENT_NAMES if mask & bit])
+
+
+class NativeWatcher(object):
+    """
+    进程内inotify监听引擎
+
+    通过ctypes调用inotify_init1/inotify_add_watch/inotify_rm_watch，
+    一次read()读取内核缓冲区中的多个事件，用struct批量解码；
+    新建或移入的子目录自动递归加入监听，与inotifywait -r行为一致；
+    同一次移动的MOVED_FROM和MOVED_TO有相同的cookie，配对成
+    ('MOVE_PAIR', (源路径, 目标路径))，超时未配对的MOVED_FROM原样上报。
+    """
+    _libc = None
+    read_size = 65536
+
+    def __init__(self, event_mask, callback, pair_timeout=0):
+        self.event_mask = event_mask
+        self.callback = callback
+        # 等待MOVED_TO的时间(秒)，0表示不配对
+        self.pair_timeout = pair_timeout
+        # {cookie: (事件, 源路径, 超时时间)}
+        self._moves = OrderedDict()
+        self.fd = -1
+        self.roots = []
+        self._wd_path = {}
+        self._path_wd = {}
+        self._running = False
+        self._thread = None
+
+    @classmethod
+    def available(cls):
+        """ 判断当前系统是否支持native方式 """
+        if cls._libc is not None:
+            return True
+        if ctypes is None or not sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            for func in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+                getattr(libc, func)
+        except (OSError, AttributeError):
+            return False
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        cls._libc = libc
+        return True
+
+    def open(self, listen_list):
+        """ 启动时加入监听失败则抛出OSError，由调用方回退到inotifywait """
+        fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_init1: %s' % os.strerror(err))
+        self.fd = fd
+        self.roots = list(listen_list)
+        for path in self.roots:
+            self.add_tree(path, strict=True)
+        Logger.info("[fs_inotify] native watches: %s" % len(self._wd_path))
+
+    def add_watch(self, path, strict=False):
+        """
+        参数：
+            strict: 监听数或内存达到上限时抛出OSError(此时监听不完整)，否则只记录日志
+        """
+        wd = self._libc.inotify_add_watch(self.fd, _fs_encode(path),
+                                          self.event_mask | IN_CREATE | IN_MOVE)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # 目录在加入监听前被删除属于正常情况
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            if strict and err in (errno.ENOSPC, errno.ENOMEM):
+                raise OSError(err, 'add watch %s: %s' % (path, os.strerror(err)))
+            if err == errno.ENOSPC:
+                Logger.error("[fs_inotify] add watch %s failed, "
+                             "please increase fs.inotify.max_user_watches" % path)
+            else:
+                Logger.error("[fs_inotify] add watch %s failed: %s"
+                             % (path, os.strerror(err)))
+            return
+        self._wd_path[wd] = path
+        self._path_wd[path] = wd
+
+    def add_tree(self, path, strict=False):
+        """ 递归加入监听，监听项可能是文件也可能是目录 """
+        self.add_watch(path, strict)
+        if not Common.is_dir(path):
+            return
+        _add_watch = self.add_watch
+        _join = os.path.join
+        for root, dirs, _ in os.walk(path):
+            for name in dirs:
+                _add_watch(_join(root, name), strict)
+
+    def forget_tree(self, path):
+        """ 目录被移走后，删除其下所有监听，避免以旧路径上报事件 """
+        prefix = os.path.join(path, '')
+        for _path in [p for p in self._path_wd
+                      if p == path or p.startswith(prefix)]:
+            wd = self._path_wd.pop(_path)
+            self._wd_path.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def decode(self, buf):
+        """ 解码一次read()得到的原始事件缓冲区 """
+        _unpack = _EVENT_STRUCT.unpack_from
+        _wd_path = self._wd_path
+        _join = os.path.join
+        offset, size = 0, len(buf)
+        while offset + _EVENT_SIZE <= size:
+            wd, mask, cookie, length = _unpack(buf, offset)
+            offset += _EVENT_SIZE
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # 内核事件队列溢出，丢失的事件无法追溯，直接同步所有监听目录
+                Logger.error("[fs_inotify] inotify queue overflow, resync listen path")
+                for root in self.roots:
+                    yield 'Q_OVERFLOW', root, 0
+                continue
+            if mask & IN_IGNORED:
+                path = _wd_path.pop(wd, None)
+                if path is not None and self._path_wd.get(path) == wd:
+                    del self._path_wd[path]
+                continue
+            directory = _wd_path.get(wd)
+            if directory is None:
+                continue
+            path = _join(directory, _fs_decode(name)) if name else directory
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self.forget_tree(path)
+            if mask & self.event_mask:
+                yield _mask_to_name(mask), path, cookie
+
+    def expire(self, now):
+        """ 取出超时未配对的MOVED_FROM事件 """
+        events = []
+        while self._moves:
+            cookie, (event, path, deadline) = next(iter(self._moves.items()))
+            if deadline > now:
+                break
+            del self._moves[cookie]
+            events.append((event, path, cookie))
+        return events
+
+    def pair(self, events):
+        """ 按cookie配对移动事件，未配对的MOVED_FROM暂存到超时 """
+        if not self.pair_timeout:
+            return events
+        now = time.time()
+        result = self.expire(now)
+        _moves = self._moves
+        for event, path, cookie in events:
+            if cookie and event.startswith('MOVED_FROM'):
+                _moves[cookie] = (event, path, now + self.pair_timeout)
+                continue
+            if cookie and event.startswith('MOVED_TO') and cookie in _moves:
+                src = _moves.pop(cookie)[1]
+                result.append((event.replace('MOVED_TO', 'MOVE_PAIR'), (src, path), cookie))
+                continue
+            if event == 'Q_OVERFLOW':
+                result.extend(self.expire(float('inf')))
+            result.append((event, path, cookie))
+        return result
+
+    def run(self, args=None):
+        self._running = True
+        _read = os.read
+        _select = select.select
+        _callback = self.callback
+        fd = self.fd
+        while self._running:
+            timeout = 1
+            if self._moves:
+                deadline = next(iter(self._moves.values()))[2]
+                timeout = min(max(deadline - time.time(), 0), 1)
+            try:
+                readable, _, _ = _select([fd], [], [], timeout)
+                if not readable:
+                    expired = self.expire(time.time())
+                    if expired:
+                        _callback(expired)
+                    continue
+                buf = _read(fd, self.read_size)
+            except (OSError, select.error) as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                if self._running:
+                    Logger.error("[fs_inotify] native read failed: %s" % e)
+                break
+            _callback(self.pair(list(self.decode(buf))))
+        self._running = False
+
+    def start(self):
+        self._thread = Common.start_thread(target=self.run)
+
+    def is_alive(self):
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(2)
+        if self.fd >= 0:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+        self.fd = -1
+        self._wd_path.clear()
+        self._path_wd.clear()
 
 
 class Inotify(Singleton):
 
     def __init__(self):
         self.listen_file = '{0}/listen.ini'.format(Global.G_RUN_DIR)
-        self.event_list = []
+        self.event_queue = EventQueue()
         self.inotify_process = None
-        self.inotify_event = ''
+        self.inotify_event = []
+        self.event_mask = 0
+        self.backend = 'native'
+        self.native = None
+        self.pair_timeout = 0.5
 
     def steps(self):
         """ 初始化配置文件和参数 """
-        self.inotify_event = ''
+        self.inotify_event = []
+        self.event_mask = 0
         try:
+            self.init_event_queue()
+            self.init_backend()
             self.init_listen_file()
             self.init_inotify_event()
             self.register_event()
@@ -37,6 +347,24 @@ class Inotify(Singleton):
         else:
             return True
 
+    def init_event_queue(self):
+        """ 事件通道大小，可选项，默认1000000 """
+        limit_size = ConfigWrapper.get_key_value('event_queue_size') or 1000000
+        self.event_queue.set_limit(int(limit_size))
+
+    def init_backend(self):
+        """ 选择监听方式，native不可用时回退到inotifywait子进程 """
+        backend = ConfigWrapper.get_key_value('inotify_backend') or 'native'
+        if backend not in ['native', 'process']:
+            raise Exception('[fs_inotify] inotify_backend is invalid:%s' % backend)
+        if backend == 'native' and not NativeWatcher.available():
+            Logger.warn('[fs_inotify] native inotify is unavailable, use inotifywait')
+            backend = 'process'
+        self.backend = backend
+        Logger.info('[fs_inotify] inotify backend: %s' % backend)
+        # 可选项，native方式等待移动事件配对的时间(秒)，0表示不配对，默认0.5
+        self.pair_timeout = float(ConfigWrapper.get_key_value('move_pair_timeout') or 0.5)
+
     def init_listen_file(self):
         """ 初始化监听的目录到文件中 """
         listen_list = ConfigWrapper.get_listen_path()
@@ -51,40 +379,22 @@ class Inotify(Singleton):
          for line in listen_list]
 
     def init_inotify_event(self):
-        """ 初始化inotifywait命令参数 """
+        """ 初始化inotifywait命令参数及native事件掩码 """
         _get_global_value = ConfigWrapper.get_key_value
-        is_delete = _get_global_value('event_delete')
-        is_create = _get_global_value('event_create')
-        is_close_write = _get_global_value('event_closewrite')
-        is_move = _get_global_value('event_move')
-        is_moved_to = _get_global_value('event_movedto')
-        is_moved_from = _get_global_value('event_movedfrom')
-        is_attrib = _get_global_value('event_attrib')
-        _event_param = ''
-        if is_delete == 'true':
-            _event_param += '-e delete'
-        if is_create == 'true':
-            _event_param += ' -e create'
-        if is_close_write == 'true':
-            _event_param += ' -e close_write'
-        if is_move == 'true':
-            _event_param += ' -e move'
-        if is_moved_to == 'true':
-            _event_param += ' -e moved_to'
-        if is_moved_from == 'true':
-            _event_param += ' -e moved_from'
-        if is_attrib == 'true':
-            _event_param += ' -e attrib'
-        if _event_param == '':
+        for key, event, mask in _CONFIG_MASKS:
+            if _get_global_value(key) != 'true':
+                continue
+            self.inotify_event += ['-e', event]
+            self.event_mask |= mask
+        if not self.inotify_event:
             raise Exception("[fs_inotify] ALL event type is false")
-        self.inotify_event += _event_param
 
     def register_event(self):
-        Receiver.bind(Global.G_INOTIFY_EVENT_MSGID, self._get_event_list)
+        Receiver.bind(Global.G_INOTIFY_EVENT_MSGID, self._get_event_queue)
         Receiver.bind(Global.G_INOTIFY_HEARTBEAT_MSGID, self._heartbeat)
 
-    def _get_event_list(self, param=None):
-        return self.event_list
+    def _get_event_queue(self, param=None):
+        return self.event_queue
 
     def _heartbeat(self, param=None):
         if self._get_inotify_pid() != -1:
@@ -92,6 +402,11 @@ class Inotify(Singleton):
         return False
 
     def _get_inotify_pid(self):
+        """ native方式在本进程内监听，返回本进程pid """
+        if self.backend == 'native':
+            if self.native and self.native.is_alive():
+                return Common.get_pid()
+            return -1
         try:
             if self.inotify_process.poll() is None:
                 pid = self.inotify_process.pid
@@ -101,32 +416,61 @@ class Inotify(Singleton):
             pid = -1
         return pid
 
+    def _native_events(self, events):
+        """ 一次read()解码出的事件整批放入事件通道 """
+        self.event_queue.put_many([(event, path) for event, path, cookie in events])
+
+    def _native_process(self):
+        """ 开启进程内inotify监听，启动失败时回退到inotifywait子进程 """
+        self.native = NativeWatcher(self.event_mask, self._native_events, self.pair_timeout)
+        try:
+            self.native.open(ConfigWrapper.get_listen_path())
+        except OSError as e:
+            Logger.error("[fs_inotify] native inotify start failed: %s, use inotifywait" % e)
+            self.native.close()
+            self.native = None
+            self.backend = 'process'
+            Common.start_thread(target=self._inotify_process)
+            return
+        self.native.start()
+        Logger.info("[fs_inotify] native inotify running in filesync(%s)"
+                    % Common.get_pid())
+
     def _inotify_process(self, args=None):
         """ 开启inotifywait进程 """
-        inotify_cmd = "{0} -rmq --format '%e %w%f' {1} --fromfile {2}".format(
-            Global.G_INOTIFY_TOOL, self.inotify_event, self.listen_file)
+        inotify_cmd = [Global.G_INOTIFY_TOOL, '-rmq', '--format', '%e %w%f'] + \
+            self.inotify_event + ['--fromfile', self.listen_file]
 
-        Logger.info("[fs_inotify] start %s" % inotify_cmd)
-        self.inotify_process = subprocess.Popen([inotify_cmd],
+        Logger.info("[fs_inotify] start %s" % ' '.join(inotify_cmd))
+        self.inotify_process = subprocess.Popen(inotify_cmd,
                                                 bufsize=10240,
                                                 stdout=subprocess.PIPE,
                                                 env={'LD_LIBRARY_PATH': Global.G_LIB_DIR},
-                                                shell=True)
+                                                close_fds=True)
         Logger.info("[fs_inotify] filesync pid: %s" % Common.get_pid())
         Logger.info("[fs_inotify] inotifywait pid: %s" % self._get_inotify_pid())
         _proc_poll = self.inotify_process.poll
         _readline = self.inotify_process.stdout.readline
-        _append = self.event_list.append
+        _put = self.event_queue.put
 
         while _proc_poll() is None:
             event_line = Common.stream_2_str(_readline()).strip()
             if event_line != "":
-                _append(event_line)
+                # 路径中可能含有空格，只按第一个空格切分
+                event, path = event_line.split(' ', 1)
+                _put((event, path))
 
     def start(self):
-        Common.start_thread(target=self._inotify_process)
+        if self.backend == 'native':
+            self._native_process()
+        else:
+            Common.start_thread(target=self._inotify_process)
 
     def stop(self):
+        if self.native:
+            Logger.info("[fs_inotify] native inotify exit")
+            self.native.close()
+            self.native = None
         try:
             if self.inotify_process.poll() is None:
                 Logger.info("[fs_inotify] inotifywait(%s) exit"
@@ -144,4 +488,3 @@ class Inotify(Singleton):
     def status(self):
         pid = self._get_inotify_pid()
         StateInfo.set_inotify_pid(pid)
-
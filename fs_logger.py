@@ -1,4 +1,9 @@
 # -*- coding: UTF-8 -*-
+import os
+import glob
+import time
+import shutil
+import tarfile
 import fs_global as Global
 from fs_util import Common, FileOP, MyThreading
 
@@ -62,15 +67,22 @@ class LogTrunc:
         Logger.info("[fs_logger] Trunk log: %s" % Global.G_LOG_FILE)
         # 获取去除.log后的日志文件前缀
         name = '.'.join(Global.G_LOG_FILE.split('.')[:-1])
-        # 回滚当前进程日志
-        Common.shell_cmd("cp {0} {0}.1 && > {0} && "
-                         "tar zcvf {1}_$(date +'%Y%m%d-%H%M').tar.gz {0}.1 && "
-                         "rm {0}.1".format(Global.G_LOG_FILE, name))
+        # 回滚当前进程日志，进程内完成，不再拉起shell/cp/tar进程
+        backup = '%s.1' % Global.G_LOG_FILE
+        try:
+            shutil.copyfile(Global.G_LOG_FILE, backup)
+            open(Global.G_LOG_FILE, 'w').close()
+            with tarfile.open('%s_%s.tar.gz' % (name, time.strftime('%Y%m%d-%H%M')), 'w:gz') as tar:
+                tar.add(backup, arcname=os.path.basename(backup))
+        finally:
+            FileOP.rm_file(backup)
 
     @classmethod
     def keep_count(cls):
-        Common.shell_cmd("ls -t %s/*.gz|sed -n '%s,1000p'|xargs rm -rf"
-                         % (Global.G_LOG_DIR, Global.G_MAX_COUNT))
+        """ 只保留最新的G_MAX_COUNT - 1个压缩日志 """
+        tars = sorted(glob.glob('%s/*.gz' % Global.G_LOG_DIR),
+                      key=os.path.getmtime, reverse=True)
+        [FileOP.rm_file(tar) for tar in tars[max(Global.G_MAX_COUNT - 1, 0):]]
 
     @classmethod
     def rollback(cls, args=None):
@@ -4,15 +4,16 @@
 
 本模块功能：
     1. 初始化并启动Slaves线程池管理类，
-    2. 定时从inotify消息队列中解析事件到任务到队列
+    2. 从inotify事件通道中解析事件到任务到队列
 """
-from time import sleep
+import time
 import fs_global as Global
 from fs_logger import Logger
 from fs_slaves import Slaves
 from fs_message import Sender
-from fs_util import Singleton, Common
-from fs_data import ConfigWrapper, TaskQueue, RetryQueue, StateInfo
+from fs_util import Singleton, Common, MyThreading
+from fs_data import ConfigWrapper, TaskQueue, RetryQueue, DeleteQueue, StateInfo, RemoteDirCache, \
+    DrrScheduler, FifoScheduler, TaskJournal, SettleWheel
 
 
 class Master(Singleton):
@@ -20,12 +21,22 @@ class Master(Singleton):
     def __init__(self):
         self.slaves = None
         self.thread_count = None
+        self.journals = []
+        self.resumed = False
+        self.batch_delete = True
+        self.settle_time = 0.5
+        self.settle_max_delay = 10
 
     def steps(self):
         try:
             self.init_task()
+            self.init_settle()
+            self.init_journal()
             self.handle_event()
             self.slaves = Slaves(self.thread_count)
+            # 已从预写日志恢复未完成的任务，启动时不再全量同步
+            self.slaves.defer_full_sync = self.resumed
+            self.slaves.batch_delete = self.batch_delete
         except Exception as e:
             Logger.error(e)
             return False
@@ -40,68 +51,166 @@ class Master(Singleton):
         self.thread_count = count
 
         limit_size = int(ConfigWrapper.get_key_value('sync_queue_size'))
-        TaskQueue.init(limit_size, count)
+        # 可选项，同一目录下待同步子任务达到该数量时合并为该目录，0表示不合并
+        fanout = int(ConfigWrapper.get_key_value('coalesce_fanout') or 32)
+        # 可选项，任务调度方式：drr(按监听目录公平调度，默认)或fifo(先进先出)
+        if ConfigWrapper.get_key_value('task_scheduler') == 'fifo':
+            scheduler = FifoScheduler(count)
+        else:
+            # 一个批次的目标同步耗时(秒)，批次大小据此自适应
+            target = float(ConfigWrapper.get_key_value('batch_target_time') or 2)
+            scheduler = DrrScheduler(target)
+        # 可选项，不小于该大小(MB)的文件进入大文件通道单独同步，0表示不区分，默认64
+        large_size = int(float(ConfigWrapper.get_key_value('large_file_size') or 64) * 1024 * 1024)
+        TaskQueue.init(limit_size, count, fanout, scheduler, large_size)
+        # 可选项，已删除的路径按监听目录成批在对端删除，而不是同步其所在目录，默认true
+        self.batch_delete = ConfigWrapper.get_key_value('batch_delete') != 'false'
+        DeleteQueue.init(limit_size)
 
         limit_size = int(ConfigWrapper.get_key_value('fail_queue_size'))
-        RetryQueue.init(limit_size)
+        # 可选项，重传退避的初始和最长时间(秒)，最大重传次数
+        base_delay = float(ConfigWrapper.get_key_value('retry_base_delay') or 10)
+        max_delay = float(ConfigWrapper.get_key_value('retry_max_delay') or 600)
+        max_attempts = int(ConfigWrapper.get_key_value('retry_max_attempts') or 10)
+        RetryQueue.init(limit_size, base_delay, max_delay, max_attempts)
+
+    def init_settle(self):
+        """
+        可选项settle_time，路径静默多少秒后才放入任务队列，0表示不等待，默认0.5；
+        可选项settle_max_delay，持续变化的路径最多等待多少秒，默认10
+        """
+        self.settle_time = float(ConfigWrapper.get_key_value('settle_time') or 0.5)
+        self.settle_max_delay = float(ConfigWrapper.get_key_value('settle_max_delay') or 10)
+
+    def init_journal(self):
+        """
+        可选项task_journal，默认true
+
+        任务队列和失败重传队列记录预写日志，
+        重放上次退出时未完成的任务，重新加入队列
+        """
+        if ConfigWrapper.get_key_value('task_journal') == 'false':
+            return
+        for queue, name in [(TaskQueue, 'task'), (RetryQueue, 'retry'), (DeleteQueue, 'delete')]:
+            journal = TaskJournal(Common.join_path(Global.G_RUN_DIR, '%s.journal' % name))
+            task_list = journal.replay()
+            queue.set_journal(journal)
+            self.journals.append(journal)
+            if task_list is None:
+                continue
+            if queue is TaskQueue:
+                self.resumed = True
+            [queue.push_task(task) for task in task_list]
+            journal.settle()
+        # 可选项，预写日志刷盘周期(秒)，默认0.2
+        period = float(ConfigWrapper.get_key_value('journal_sync_interval') or 0.2)
+        MyThreading(func=self.flush_journal,
+                    period=period
+                    ).start()
+
+    def flush_journal(self, args=None):
+        [journal.flush() for journal in self.journals]
 
     def handle_event(self):
         Common.start_thread(target=self.parse_task, args=())
 
-    @classmethod
-    def parse_task(cls, args=None):
+    def parse_task(self, args=None):
         """
         事件处理函数
 
-        死循环处理inotify原始事件；
-        如果事件是监控的同步文件，则直接将文件放入队列(同步文件)
-        否则将该事件的上级目录放入队列(同步目录)
+        死循环处理inotify原始事件(事件类型, 路径)；
+        事件到达即唤醒，一次取走事件通道中积压的全部事件；
+        路径先进入静默时间轮，静默settle_time秒(最多settle_max_delay秒)后处理：
+        存在的文件或目录直接放入队列，由批量同步和大文件通道按路径同步，
+        不再同步其所在目录；监控的同步文件总是直接放入队列；
+        已不存在的路径放入删除队列，在对端成批删除；
+        不能放入删除队列时将该事件的上级目录放入队列(同步目录)；
+        配对的移动事件(MOVE_PAIR, (源路径, 目标路径))先在对端mv，
+        再按目标路径放入队列，不能mv时按两端的路径分别处理
 
         参数: None
 
         返回值: None
         """
-        event_list = Sender.send(Global.G_INOTIFY_EVENT_MSGID)
-        _evt_pop = event_list.pop
+        event_queue = Sender.send(Global.G_INOTIFY_EVENT_MSGID)
+        _get_batch = event_queue.get_batch
         _is_listen_file = ConfigWrapper.is_listen_file
         _get_value = ConfigWrapper.get_key_value
-        _is_dir = Common.is_dir
+        _is_exists = Common.is_exists
         _dirname = Common.dirname
         _push_task = TaskQueue.push_task
+        _push_delete = DeleteQueue.push_task if self.batch_delete else None
+        _invalidate = RemoteDirCache.invalidate
+        _time = time.time
+        wheel = SettleWheel(self.settle_time, self.settle_max_delay)
+        _touch = wheel.touch
+
+        def _release(_path):
+            if _is_listen_file(_path) or _is_exists(_path):
+                _push_task(_path)
+            elif not (_push_delete and not _is_exists(_path) and _push_delete(_path)):
+                _push_task(_dirname(_path))
 
         while 1:
-            while 1:
-                if not len(event_list):
-                    break
-                event, path = _evt_pop(0).split()
-                Logger.debug("[fs_master] get inotifywait event: %s %s"
+            """ 无事件时最多等待sync_period或下一个时间槽到期后再检查一次 """
+            batch, overflow = _get_batch(wheel.timeout(_time(), float(_get_value('sync_period'))))
+            if overflow:
+                # 事件通道溢出，丢弃的事件无法追溯，同步所有监听目录
+                Logger.error("[fs_master] event queue overflow, resync listen path")
+                wheel.drain()
+                [_push_task(path) for path in ConfigWrapper.get_listen_path()]
+            if batch:
+                Logger.debug("[fs_master] got %s inotify events" % len(batch))
+            now = _time()
+            for event, path in batch:
+                Logger.debug("[fs_master] get inotify event: %s %s"
                              % (event, path))
 
-                if not _is_listen_file(path) and not _is_dir(path):
-                    path = _dirname(path)
-                _push_task(path)
-
-            """ 防止同一事件频繁同步，每次等待一段时间 """
-            sleep(float(_get_value('sync_period')))
+                # 目录被删除或移走后，对端已存在目录的缓存失效
+                if 'ISDIR' in event and ('DELETE' in event or 'MOVED_FROM' in event):
+                    _invalidate(path)
+                paths = (path,)
+                if event.startswith('MOVE_PAIR'):
+                    src, dst = path
+                    if 'ISDIR' in event:
+                        _invalidate(src)
+                    task = dst if _is_listen_file(dst) or _is_exists(dst) else _dirname(dst)
+                    if self.slaves.move(src, dst, task):
+                        continue
+                    paths = path
+                if not self.settle_time:
+                    [_release(path) for path in paths]
+                    continue
+                for path in paths:
+                    _touch(path, now)
+            [_release(path) for path in wheel.expire(_time())]
 
     def start(self):
         self.slaves.start()
 
     def status(self):
-        syncing, connect = self.slaves.status()
+        syncing, connect, probe, compress = self.slaves.status()
         StateInfo.set_syncing_task(syncing)
         StateInfo.set_connected_ip(connect)
+        StateInfo.set_remote_probe(probe)
+        StateInfo.set_compress(compress)
         StateInfo.set_waiting_task(TaskQueue.status())
         StateInfo.set_retry_task(RetryQueue.status())
+        StateInfo.set_delete_task(DeleteQueue.status())
 
     def reload(self):
         """
         reload之前不存在的监听目录在reload之后存在，
         则此目录需要加入任务队列 
         """
+        TaskQueue.set_listen()
         Logger.info("[fs_master] appear listen: %s" % Global.G_APPEAR_LISTEN)
         [TaskQueue.push_task(path) for path in Global.G_APPEAR_LISTEN]
 
+    def stop(self):
+        self.slaves.stop()
+        [journal.close() for journal in self.journals]
+
     def pause(self):
         self.slaves.pause()
 
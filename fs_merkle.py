@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+"""
+Merkle树对账模块
+
+按元数据(名称、类型、大小、mtime、链接目标)自底向上计算目录哈希，
+本端与对端逐层比较，只深入哈希不同的子目录，一层一次往返：
+    1. MerkleTree: 目录哈希树，只缓存目录哈希，比较时再列出目录内容；
+    2. MerkleSession: 经ssh在对端运行本模块作为应答进程，
+        请求和应答都是一行json。
+
+注：本模块只依赖标准库，源码会被发送到对端执行，不能引用其他fs_模块
+"""
+import os
+import sys
+import json
+import stat
+import zlib
+import base64
+import threading
+import subprocess
+from hashlib import md5
+from fnmatch import fnmatch
+
+
+class MerkleTree(object):
+    """
+    目录哈希树
+
+    目录哈希由其下条目(名称, 类型, 值)列表计算，值为：
+        文件: [大小, mtime(秒)]，rsync -a 会保持两端一致；
+        链接: 链接目标；
+        目录: 子目录哈希
+    """
+
+    def __init__(self, root, excludes=()):
+        self.root = root
+        self.excludes = list(excludes)
+        # {相对路径: 目录哈希}，根目录为''
+        self._hashes = {}
+
+    @classmethod
+    def source(cls):
+        """ 在对端运行本模块的python -c参数，压缩编码后只有ascii字符 """
+        path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        with open(path, 'rb') as f:
+            code = base64.b64encode(zlib.compress(f.read().replace(b'\r\n', b'\n')))
+        return "import zlib,base64;exec(compile(zlib.decompress(base64.b64decode('%s')),'fs_merkle','exec'))" \
+               % code.decode('ascii')
+
+    def path(self, rel):
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def _excluded(self, name):
+        for pattern in self.excludes:
+            if fnmatch(name, pattern):
+                return True
+        return False
+
+    def listing(self, rel):
+        """ 列出目录下的条目，目录不存在时返回None """
+        path = self.path(rel)
+        try:
+            names = sorted(os.listdir(path))
+        except OSError:
+            return None
+        entries = []
+        for name in names:
+            if self._excluded(name):
+                continue
+            child = os.path.join(path, name)
+            try:
+                st = os.lstat(child)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                entries.append([name, 'd', self.hash(os.path.join(rel, name))])
+            elif stat.S_ISLNK(st.st_mode):
+                entries.append([name, 'l', os.readlink(child)])
+            else:
+                entries.append([name, 'f', [st.st_size, int(st.st_mtime)]])
+        return entries
+
+    @classmethod
+    def _digest(cls, entries):
+        data = json.dumps(entries, separators=(',', ':'))
+        return md5(data.encode('utf-8', 'surrogateescape')
+                   if not isinstance(data, bytes) else data).hexdigest()
+
+    def hash(self, rel):
+        """ 目录哈希，构建之后新出现的目录此时再计算 """
+        if rel not in self._hashes:
+            entries = self.listing(rel)
+            self._hashes[rel] = None if entries is None else self._digest(entries)
+        return self._hashes[rel]
+
+    def build(self):
+        """ 自底向上计算全部目录哈希，返回根目录哈希 """
+        self._hashes = {}
+        for root, dirs, files in os.walk(self.root, topdown=False):
+            rel = os.path.relpath(root, self.root)
+            rel = '' if rel == '.' else rel
+            self._hashes[rel] = self._digest(self.listing(rel) or [])
+        return self._hashes.get('')
+
+    def diff(self, query):
+        """
+        与对端比较
+
+        参数：
+            query: 查询函数，参数为相对路径列表，返回{相对路径: [哈希, 条目列表]}
+
+        返回值：
+            需要同步的相对路径列表：对端缺少或不同的文件和目录，
+            类型不同时同步该路径，由rsync --delete替换对端的条目;
+            需要在对端删除的相对路径列表：对端多余的条目
+        """
+        tasks, deletes = [], []
+        pending = ['']
+        while pending:
+            reply = query(pending)
+            next_level = []
+            for rel in pending:
+                remote_hash, remote_entries = reply.get(rel) or (None, None)
+                if remote_entries is None:
+                    tasks.append(rel)
+                    continue
+                if not rel and remote_hash == self.hash(rel):
+                    return [], []
+                local = dict((e[0], e) for e in self.listing(rel) or [])
+                remote = dict((e[0], e) for e in remote_entries)
+                # 多余的条目只在对端删除，其余条目照常比较
+                deletes.extend(os.path.join(rel, name) for name in set(remote) - set(local))
+                for name, entry in local.items():
+                    other = remote.get(name)
+                    if other == entry:
+                        continue
+                    child = os.path.join(rel, name)
+                    if other is None or other[1] != entry[1]:
+                        tasks.append(child)
+                    elif entry[1] == 'd':
+                        next_level.append(child)
+                    else:
+                        tasks.append(child)
+            pending = next_level
+        return sorted(set(tasks)), sorted(set(deletes))
+
+    def serve(self, stdin, stdout):
+        """ 对端应答进程：每读一行请求，回复各目录的哈希和条目 """
+        self.build()
+        for line in iter(stdin.readline, ''):
+            reply = dict((rel, [self.hash(rel), self.listing(rel)])
+                         for rel in json.loads(line))
+            stdout.write(json.dumps(reply) + '\n')
+            stdout.flush()
+
+
+class MerkleSession(object):
+    """
+    对端应答进程会话
+
+    参数：
+        argv: 启动对端应答进程的命令(ssh ... python -c MerkleTree.source() 根目录 过滤条件)
+        timeout: 整个会话的超时时间(秒)，超时后kill
+    """
+
+    def __init__(self, argv, timeout):
+        self._devnull = open(os.devnull, 'wb')
+        self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=self._devnull)
+        self._timer = threading.Timer(timeout, self.proc.kill)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def query(self, rels):
+        self.proc.stdin.write((json.dumps(rels) + '\n').encode('ascii'))
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise IOError('merkle helper exited, ret: %s' % self.proc.poll())
+        return json.loads(line.decode('ascii'))
+
+    def close(self):
+        self._timer.cancel()
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self._devnull.close()
+
+
+if __name__ == '__main__':
+    MerkleTree(sys.argv[1], sys.argv[2:]).serve(sys.stdin, sys.stdout)
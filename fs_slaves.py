@@ -4,12 +4,34 @@
 
 本模块负责文件/目录的同步细节，以及管控等
 """
+import os
+import re
+import time
 import fs_global as Global
+from fnmatch import fnmatch
+from functools import partial
 from time import sleep
-from fs_data import TaskQueue, RetryQueue
+from fs_data import TaskQueue, RetryQueue, DeleteQueue, ListenIndex, RemoteDirCache, SyncManifest
 from fs_logger import Logger
 from fs_data import ConfigWrapper
+from fs_connect import SshPool, RemoteBreaker, TcpProber, BandwidthGovernor, CompressAdvisor
+from fs_merkle import MerkleTree, MerkleSession
+from collections import OrderedDict, deque
+from threading import Lock, Condition, BoundedSemaphore
 from fs_util import ThreadPool, MyThreading, Common, FileOP, Counter, Singleton
+try:
+    from fs_async import AsyncEngine
+except (ImportError, SyntaxError):
+    # python2不支持asyncio
+    AsyncEngine = None
+
+
+# rsync错误输出中带引号的路径，如: rsync: link_stat "/a/b" failed: ...
+_RSYNC_ERR_PATH = re.compile(r'^rsync: .*?"([^"]+)"')
+# rsync接收端临时文件名，如: .file.Ab12Cd
+_RSYNC_TMP_NAME = re.compile(r'^\.(.+)\.[A-Za-z0-9]{6}$')
+# --itemize-changes的逐项变更行，限速时输出中还有--stats统计行
+_RSYNC_ITEM = re.compile(r'^(\*deleting|[<>ch.][fdLDS])', re.M)
 
 
 class WarnExcept(Exception):
@@ -28,23 +50,93 @@ class Slaves(Singleton):
     def __init__(self, count):
         self.count = count
         self.pool = None
-        self.curr_listen = None
-        self.last_listen = None
-        self.retry_period = 60
+        self.large_pool = None
+        # 为True时首次全量同步延后一个周期
+        self.defer_full_sync = False
+        self.incremental_full_sync = True
+        self.merkle_reconcile = False
+        self.merkle_python = 'python3'
+        self.probe_method = 'tcp'
+        # 为False时已删除的路径按其所在目录同步
+        self.batch_delete = True
+        # 各任务的重传时间由RetryQueue按退避计算，这里只是检查周期
+        self.retry_period = 5
         self.check_period = 10
-        self.worker_period = 1
+        # 工作线程等待任务的最长时间，超时后重新检查暂停状态
+        self.worker_wait = 1
         self.syncing = []
         self.ready_flag = False
+        self.batch_mode = True
+        self.remote_limit = 4
+        self.rsync_timeout = 3600
+        self.remote_timeout = 60
+        self.remote_slots = {}
+        self.slots_lock = Lock()
+        # 待在对端执行的移动，按发生顺序逐个执行
+        self.moves = deque()
+        self.moves_cond = Condition(Lock())
 
     def init(self):
         """ 重写基类的init, 用于避免使用signal机制，统一由Master调度 """
         pass
 
+    def set_remote_limit(self):
+        """ 可选项，每个对端IP同时进行的同步数上限，默认4 """
+        self.remote_limit = int(ConfigWrapper.get_key_value('remote_concurrency') or 4)
+
+    def get_slot(self, ip):
+        """ 获取对端IP的并发信号量 """
+        with self.slots_lock:
+            if ip not in self.remote_slots:
+                self.remote_slots[ip] = BoundedSemaphore(self.remote_limit)
+            return self.remote_slots[ip]
+
+    def fan_out(self, cmd_dict, func):
+        """
+        并发执行到各个对端的同步命令
+
+        每个对端一个线程，受该对端的并发上限约束，
+        总耗时取决于最慢的对端而不是所有对端之和
+
+        参数：
+            cmd_dict: {对端IP: 同步命令}
+            func: 执行同步命令的函数，参数为(对端IP, 同步命令)
+
+        返回值：
+            {对端IP: func的返回值}
+        """
+        def run(_ip, _cmd):
+            with self.get_slot(_ip):
+                result[_ip] = func(_ip, _cmd)
+
+        result, threads = {}, []
+        items = list(cmd_dict.items())
+        # 只有一个对端时直接在当前线程执行
+        if len(items) == 1:
+            run(*items[0])
+            return result
+        for ip, cmd in items:
+            threads.append(Common.start_thread(run, (ip, cmd)))
+        # 等待所有线程结束 #
+        [t.join() for t in threads]
+        return result
+
+    def set_batch_mode(self):
+        """ 可选项，是否按(监听目录, 对端IP)批量同步，默认开启 """
+        self.batch_mode = (ConfigWrapper.get_key_value('batch_sync') or 'true') == 'true'
+
+    def set_full_sync_mode(self):
+        """ 可选项，全量同步是否只同步与本地清单相比有变化的路径，默认开启 """
+        self.incremental_full_sync = ConfigWrapper.get_key_value('incremental_full_sync') != 'false'
+        # 可选项，全量同步时与对端比较Merkle树，只同步不一致的子树，默认关闭
+        self.merkle_reconcile = ConfigWrapper.get_key_value('merkle_reconcile') == 'true'
+        self.merkle_python = ConfigWrapper.get_key_value('merkle_python') or 'python3'
+
     def find_listen(self, task):
         """
         找到task对应配置文件中监听的目录
 
-        先从当前配置文件数据字典中找，
+        由ListenIndex按路径分量查找，当前配置优先，
         如果没找到再到reload之前的配置文件数据中找，
 
         参数：
@@ -54,23 +146,9 @@ class Slaves(Singleton):
             任务所在的监听目录;
             是否是上一次的配置文件数据
         """
-        _contain = Common.is_contain
-
-        for listen in self.curr_listen:
-            if not _contain(listen, task):
-                continue
-            else:
-                return listen, False
+        return ListenIndex.find(task)
 
-        # 继续从reload之前的配置中寻找
-        for listen in self.last_listen:
-            if not _contain(listen, task):
-                continue
-            else:
-                return listen, True
-        return None, None
-
-    def combine(self, thread_id, task):
+    def combine(self, thread_id, task, large=False, ips=None):
         """
         组合rsync同步参数
 
@@ -78,9 +156,11 @@ class Slaves(Singleton):
 
         参数：
             task: 具体任务
+            large: 是否是大文件通道的任务
+            ips: 只同步到这些对端，None表示全部对端
 
         返回值：
-            rsync同步命令字符串
+            {对端IP: rsync同步命令参数列表}
         """
 
         # 如果是临时目录或文件，同步可能会失败，需要判断一下目录或文件在不在
@@ -94,49 +174,57 @@ class Slaves(Singleton):
         if last:
             Logger.warn('[thread%s] %s in last config section %s' % (thread_id, task, listen))
 
-        _get_listen_value = ConfigWrapper.get_key_value
-        remote_mkdir = _get_listen_value('make_remote_dir', last=last)
-        remote_ips = _get_listen_value('remote_ip', listen, last).split(',')
-        checksum = _get_listen_value('checksum', listen, last)
-        compress = _get_listen_value('compress', listen, last)
-        exclude = _get_listen_value('exclude', listen, last)
-        param = "%s -a" % Global.G_RSYNC_TOOL
-        task_dir, task_file = Common.split_path(task)
-
-        if checksum == 'true':
-            param += 'c'
-        if compress == 'true':
-            param += 'z'
-        if exclude:
-            # 只有一个过滤条件时，不能用{}，否则过滤会失效
-            if len(exclude.split(',')) == 1:
-                param += ' --exclude=%s' % exclude
-            else:
-                param += ' --exclude={%s}' % exclude
+        tpl = ListenIndex.template(listen, last)
+        rsh = '--rsh=%s' % SshPool.ssh_cmd()
+        task_dir = Common.dirname(task)
+        mix = CompressAdvisor.profile([task]) if tpl.adaptive_compress else None
 
         cmd_dict = {}
         """ 判断IP是否可达 """
-        for remote_ip in remote_ips:
+        for remote_ip in tpl.remote_ips:
+            if ips is not None and remote_ip not in ips:
+                continue
             if remote_ip not in Global.G_CONNECT_IP_LIST:
                 Logger.warn("[thread%s] %s is unavailable IP, ignore %s" % (thread_id, remote_ip, task))
+                # 对端恢复后由下次全量同步补齐
+                SyncManifest.forget(task)
+                continue
+            if not RemoteBreaker.allow(remote_ip):
+                Logger.debug("[thread%s] %s is breaking, retry %s later" % (thread_id, remote_ip, task))
+                RetryQueue.push_task(task, failed=False, ip=remote_ip, due=RemoteBreaker.resume_at(remote_ip))
                 continue
 
             # 注：任务可能是文件也可能是目录
-            # 统一取上一层目录，进入后同步
-            _param = "%s --delete --rsh=ssh %s %s@%s:%s" % (param, task_file, Global.G_RSYNC_USER, remote_ip, task_dir)
-            # 如果full_sync为false或者其他场景下，同步可能会因对端的目录不存在而报错
-            # 这里根据make_remote_dir配置，判断是否先登录对端创建该目录，开启会影响同步性能
-            prev_cmd = None
-            if remote_mkdir == 'true':
-                prev_cmd = "ssh %s@%s 'mkdir -p %s'" % (Global.G_RSYNC_USER, remote_ip, task_dir)
-            cmd = "cd %s && %s" % (task_dir, _param)
-            if prev_cmd:
-                cmd = ';'.join([prev_cmd, cmd])
-            cmd_dict[remote_ip] = cmd
+            # 统一同步到对端的上一层目录中
+            # 对端目录已由make_remote_dirs在同步前批量创建
+            cmd = (tpl.large if large else tpl.single) + [rsh, task, '%s:%s' % (tpl.targets[remote_ip], task_dir)]
+            cmd_dict[remote_ip] = CompressAdvisor.apply(remote_ip, cmd, mix, tpl.compress_level) if mix is not None else cmd
         return cmd_dict
 
+    def transfer(self, ip, cmd, bulk):
+        """
+        在分配的带宽内执行一次rsync
+
+        参数：
+            bulk: 是否是批量同步(全量同步、大文件)，优先级低于增量同步
+
+        返回值:
+            退出值, 输出, 错误输出
+        """
+        limit = BandwidthGovernor.acquire(ip, bulk)
+        cmd = BandwidthGovernor.govern(cmd, limit)
+        Logger.debug("[fs_slaves] exec: %s" % ' '.join(cmd))
+        start = time.time()
+        ret, out, err = '', '', ''
+        try:
+            ret, out, err = Common.exec_cmd(cmd, self.rsync_timeout)
+        finally:
+            BandwidthGovernor.release(ip, bulk, limit, out, time.time() - start)
+        CompressAdvisor.observe(ip, cmd, out, time.time() - start)
+        return ret, out, err
+
     @Counter
-    def rsync(self, cmd):
+    def rsync(self, ip, cmd, bulk=False):
         """
         同步动作函数
 
@@ -147,31 +235,35 @@ class Slaves(Singleton):
             ret:   退出值
             detail:命令执行结构详细输出信息
         """
-        Logger.debug("[fs_slaves] exec: %s" % cmd)
-        ret, out, err = Common.shell_cmd(cmd)
+        ret, out, err = self.transfer(ip, cmd, bulk)
         return ret, err
 
-    def doing(self, thread_id, task, is_retry):
+    def doing(self, thread_id, task, is_retry, large=False, ips=None):
         """ 先组装同步参数再执行同步 """
         ret, detail = -1, None
         self.syncing.append(task)
         try:
-            cmd_dict = self.combine(thread_id, task)
-            # 执行同步动作
-            for ip, cmd in cmd_dict.items():
-                ret, detail = self.rsync(cmd)
+            cmd_dict = self.combine(thread_id, task, large, ips)
+            # 并发执行同步动作，按对端汇总结果
+            start = time.time()
+            results = self.fan_out(cmd_dict, partial(self.rsync, bulk=large or thread_id == 'Full'))
+            if not large:
+                TaskQueue.feedback(self.find_listen(task), 1, time.time() - start)
+            for ip, (ret, detail) in results.items():
+                RemoteBreaker.record(ip, ret)
                 detail = "To %s, %s" % (ip, detail)
                 # 0表示成功
                 if not ret:
                     Logger.info("[thread%s] sync success %s, %s" % (thread_id, task, detail))
                 else:
+                    RemoteDirCache.discard(ip, Common.dirname(task))
                     info = "[thread%s] sync failed %s, %s" % (thread_id, task, detail)
                     if is_retry:
                         Logger.error(info)
                     else:
                         Logger.warn(info)
-                        # 失败且不是失败重传任务时，放入失败队列进行重试
-                        RetryQueue.push_task(task)
+                    # 放入失败队列，按退避时间重传到该对端，超过重传次数后放弃
+                    RetryQueue.push_task(task, ip=ip)
         except WarnExcept as e:
             Logger.warn("[thread%s] WarnExcept %s %s" % (thread_id, task, e))
         except ErrorExcept as e:
@@ -179,7 +271,411 @@ class Slaves(Singleton):
         finally:
             self.syncing.remove(task)
 
-    def deal(self, thread_id, task_list, is_retry=False):
+    def combine_batch(self, thread_id, listen, last, task_list, ips=None):
+        """
+        组合批量rsync同步参数
+
+        同一监听目录下的所有任务以相对同步根目录的路径写入files-from文件，
+        一次同步到对端
+
+        参数：
+            listen: 监听目录
+            last: 是否是上一次的配置文件数据
+            task_list: 该监听目录下的任务列表
+            ips: 只同步到这些对端，None表示全部对端
+
+        返回值：
+            同步根目录;
+            {对端IP: rsync同步命令参数列表}
+        """
+        tpl = ListenIndex.template(listen, last)
+        rsh = '--rsh=%s' % SshPool.ssh_cmd()
+        base = tpl.base
+        src = Common.join_path(base, '')
+        # 异步引擎中一个批次的各监听目录并发同步，每个监听目录单独一个files-from文件
+        files_from = '%s/files-from.%s.%s' % (Global.G_RUN_DIR, thread_id, tpl.index)
+        if not FileOP.write_path_list(files_from, [os.path.relpath(task, base) for task in task_list]):
+            # files-from不完整时rsync也会成功退出，整批任务重传
+            Logger.error("[thread%s] write %s failed, retry %s tasks of %s later"
+                         % (thread_id, files_from, len(task_list), listen))
+            [RetryQueue.push_task(task) for task in task_list]
+            return base, {}
+        mix = CompressAdvisor.profile(task_list) if tpl.adaptive_compress else None
+
+        cmd_dict = {}
+        for remote_ip in tpl.remote_ips:
+            if ips is not None and remote_ip not in ips:
+                continue
+            if remote_ip not in Global.G_CONNECT_IP_LIST:
+                Logger.warn("[thread%s] %s is unavailable IP, ignore %s tasks of %s"
+                            % (thread_id, remote_ip, len(task_list), listen))
+                # 对端恢复后由下次全量同步补齐
+                [SyncManifest.forget(task) for task in task_list]
+                continue
+            if not RemoteBreaker.allow(remote_ip):
+                Logger.debug("[thread%s] %s is breaking, retry %s tasks of %s later"
+                             % (thread_id, remote_ip, len(task_list), listen))
+                due = RemoteBreaker.resume_at(remote_ip)
+                [RetryQueue.push_task(task, failed=False, ip=remote_ip, due=due) for task in task_list]
+                continue
+            # files-from中为相对同步根目录的路径，隐含--relative，
+            # 对端只需保证同步根目录存在，由make_remote_dirs在同步前批量创建
+            cmd = tpl.batch + ['--files-from=%s' % files_from, rsh, src,
+                               '%s:%s' % (tpl.targets[remote_ip], src)]
+            cmd_dict[remote_ip] = CompressAdvisor.apply(remote_ip, cmd, mix, tpl.compress_level) if mix is not None else cmd
+        return base, cmd_dict
+
+    @classmethod
+    def failed_tasks(cls, base, task_list, ret, err):
+        """
+        从rsync错误输出中找出同步失败的任务
+
+        退出码23/24(部分失败/文件消失)时，把错误信息中的路径对应到任务，
+        对应不上或其他退出码时，认为全部任务失败
+
+        返回值：
+            失败的任务列表
+        """
+        if not ret:
+            return []
+        if ret not in (23, 24):
+            return task_list
+        _task_set = set(task_list)
+        failed = []
+        for line in err.splitlines():
+            # 同步过程中被删除的文件，由删除事件触发同步
+            if line.startswith('file has vanished'):
+                continue
+            match = _RSYNC_ERR_PATH.match(line)
+            if not match:
+                continue
+            path = match.group(1)
+            if not path.startswith('/'):
+                path = Common.join_path(base, path)
+            path = os.path.normpath(path)
+            tmp_name = _RSYNC_TMP_NAME.match(os.path.basename(path))
+            if tmp_name:
+                path = Common.join_path(Common.dirname(path), tmp_name.group(1))
+            # 逐级向上找到对应的任务
+            while path not in _task_set:
+                parent = Common.dirname(path)
+                if parent == path:
+                    return task_list
+                path = parent
+            if path not in failed:
+                failed.append(path)
+        if ret == 23 and not failed:
+            return task_list
+        return failed
+
+    def rsync_batch(self, ip, cmd, bulk=False):
+        """
+        批量同步动作函数
+
+        返回值:
+            ret: 退出值
+            out: 逐项变更输出(--itemize-changes)
+            err: 错误输出
+            cost: 耗时
+        """
+        start = time.time()
+        ret, out, err = self.transfer(ip, cmd, bulk)
+        return ret, out, err, time.time() - start
+
+    def doing_batch(self, thread_id, listen, last, task_list, is_retry, ips=None):
+        """ 同一监听目录下的任务批量同步到各个对端 """
+        self.syncing.extend(task_list)
+        try:
+            base, cmd_dict = self.combine_batch(thread_id, listen, last, task_list, ips)
+            results = self.fan_out(cmd_dict, partial(self.rsync_batch, bulk=thread_id == 'Full'))
+            self.feedback(listen, last, task_list, results)
+            self.report_batch(thread_id, listen, base, task_list, results, is_retry)
+        finally:
+            [self.syncing.remove(task) for task in task_list]
+
+    @classmethod
+    def feedback(cls, listen, last, task_list, results):
+        """ 上报批次耗时，各对端并发同步，取最长的一个 """
+        if results:
+            cost = max(result[3] for result in results.values())
+            TaskQueue.feedback((listen, last), len(task_list), cost)
+
+    def report_batch(self, thread_id, listen, base, task_list, results, is_retry):
+        """
+        汇总批量同步结果
+
+        参数：
+            results: {对端IP: (退出值, 输出, 错误输出, 耗时)}
+        """
+        for ip, (ret, out, err, cost) in results.items():
+            RemoteBreaker.record(ip, ret)
+            failed = self.failed_tasks(base, task_list, ret, err)
+            detail = "To %s, Cost time %.3fs, %s items changed" \
+                     % (ip, cost, len(_RSYNC_ITEM.findall(out)))
+            if not failed:
+                Logger.info("[thread%s] sync success %s tasks of %s, %s"
+                            % (thread_id, len(task_list), listen, detail))
+                continue
+            RemoteDirCache.discard(ip, base)
+            info = "[thread%s] sync failed %s/%s tasks of %s, %s; (ret:%s, err:%s)\n%s" \
+                   % (thread_id, len(failed), len(task_list), listen,
+                      detail, ret, err, '\n'.join(failed))
+            if is_retry:
+                Logger.error(info)
+            else:
+                Logger.warn(info)
+            # 只把失败的任务放入失败队列，按退避时间重传到该对端，超过重传次数后放弃
+            [RetryQueue.push_task(task, ip=ip) for task in failed]
+
+    def exec_remote(self, ip, cmd):
+        return Common.exec_cmd(cmd, self.remote_timeout)
+
+    def make_remote_dirs(self, thread_id, dir_list):
+        """
+        批量创建对端目录
+
+        如果full_sync为false或者其他场景下，同步可能会因对端的目录不存在而报错，
+        这里根据make_remote_dir配置，同步前先登录对端创建目录；
+        已确认存在的目录不再创建，每个对端一批任务只登录一次
+
+        参数：
+            dir_list: [(rsync参数模板, 需要存在的对端目录)]
+
+        返回值：None
+        """
+        dir_map = {}
+        for tpl, _dir in dir_list:
+            if not tpl.remote_mkdir:
+                continue
+            for ip in tpl.remote_ips:
+                if ip in Global.G_CONNECT_IP_LIST and RemoteBreaker.allow(ip):
+                    dir_map.setdefault(ip, set()).add(_dir)
+        cmd_dict, missing_map = {}, {}
+        for ip, dirs in dir_map.items():
+            missing = RemoteDirCache.missing(ip, sorted(dirs))
+            if not missing:
+                continue
+            missing_map[ip] = missing
+            # 远端命令仍由对端shell解析，目录需要转义
+            remote_cmd = 'mkdir -p %s' % ' '.join([Common.quote(d) for d in missing])
+            cmd_dict[ip] = SshPool.ssh_argv() + ['%s@%s' % (Global.G_RSYNC_USER, ip), remote_cmd]
+        for ip, (ret, out, err) in self.fan_out(cmd_dict, self.exec_remote).items():
+            if ret:
+                Logger.warn("[thread%s] make remote dir on %s failed, (ret:%s, err:%s)"
+                            % (thread_id, ip, ret, err))
+                continue
+            Logger.debug("[thread%s] make remote dir on %s: %s"
+                         % (thread_id, ip, missing_map[ip]))
+            RemoteDirCache.add(ip, missing_map[ip])
+
+    def move(self, src, dst, task):
+        """
+        在对端重命名，避免重新传输移动过的文件或目录
+
+        两端在同一监听目录下时加入移动队列，由移动线程在各对端mv，
+        全部成功时不再同步(checksum为true时rsync要重新读取整个目录树)，
+        移动后的修改由目标路径上的事件照常同步；
+        有对端mv失败时(对端没有源路径等)把task放入任务队列由rsync兜底，
+        源路径按删除处理
+
+        参数：
+            src: 源路径
+            dst: 目标路径
+            task: 移动后需要同步的任务
+
+        返回值：
+            是否加入移动队列
+        """
+        listen, last = self.find_listen(src)
+        if not listen or last or self.find_listen(dst) != (listen, last):
+            return False
+        tpl = ListenIndex.template(listen, last)
+        for path in (src, dst):
+            name = os.path.basename(path)
+            if [e for e in tpl.excludes if fnmatch(name, e)]:
+                return False
+        with self.moves_cond:
+            self.moves.append((tpl, src, dst, task))
+            self.moves_cond.notify()
+        return True
+
+    def move_process(self, args=None):
+        """ 移动线程：逐个在各对端执行mv，有对端失败时放入任务队列 """
+        with self.moves_cond:
+            if not self.moves:
+                self.moves_cond.wait(self.worker_wait)
+            if not self.moves:
+                return
+            tpl, src, dst, task = self.moves.popleft()
+        moved = False
+        try:
+            remote_cmd = 'mv -f -T %s %s' % (Common.quote(src), Common.quote(dst))
+            if tpl.remote_mkdir:
+                remote_cmd = 'mkdir -p %s && %s' % (Common.quote(Common.dirname(dst)), remote_cmd)
+            ips = [ip for ip in tpl.remote_ips if ip in Global.G_CONNECT_IP_LIST]
+            cmd_dict = dict((ip, SshPool.ssh_argv() + [tpl.targets[ip], remote_cmd])
+                            for ip in ips if RemoteBreaker.allow(ip))
+            results = self.fan_out(cmd_dict, self.exec_remote)
+            for ip, (ret, out, err) in results.items():
+                if ret:
+                    Logger.info("[threadMove] move %s to %s on %s failed, fall back to rsync, "
+                                "(ret:%s, err:%s)" % (src, dst, ip, ret, err.strip()))
+                else:
+                    Logger.info("[threadMove] move %s to %s on %s" % (src, dst, ip))
+            moved = len(results) == len(ips) and not [r for r in results.values() if r[0]]
+        finally:
+            if not moved:
+                TaskQueue.push_task(task)
+                self.push_delete(src)
+
+    def push_delete(self, path):
+        """ 已不存在的路径放入删除队列，不能放入时同步其所在目录 """
+        if not (self.batch_delete and DeleteQueue.push_task(path)):
+            TaskQueue.push_task(Common.dirname(path))
+
+    def delete_process(self, args=None):
+        """
+        删除线程处理函数
+
+        取走删除队列中积压的全部路径，按监听目录分组后批量删除
+        """
+        task_list = DeleteQueue.request_task(self.worker_wait)
+        if not task_list:
+            return
+        try:
+            groups = OrderedDict()
+            for task in task_list:
+                listen, last = self.find_listen(task)
+                if not listen:
+                    Logger.error("[threadDelete] ErrorExcept %s not in config ini, ignore..." % task)
+                    continue
+                # 监听目录本身被删除时不删除对端
+                if task == listen:
+                    Logger.warn("[threadDelete] listen path %s is deleted, ignore..." % task)
+                    continue
+                groups.setdefault((listen, last), []).append(task)
+            for (listen, last), _tasks in groups.items():
+                self.delete_batch(listen, last, _tasks)
+        finally:
+            DeleteQueue.done(task_list)
+
+    def delete_batch(self, listen, last, task_list):
+        """
+        在对端批量删除
+
+        已删除的目录只保留最上层，files-from中的路径本地都已不存在，
+        rsync --delete-missing-args逐个在对端删除，不比较其所在目录；
+        期间又被创建的路径则照常同步；失败时重传其所在目录
+
+        参数：
+            listen: 监听目录
+            last: 是否是上一次的配置文件数据
+            task_list: 该监听目录下已删除的路径
+        """
+        tpl = ListenIndex.template(listen, last)
+        base = tpl.base
+        src = Common.join_path(base, '')
+        prefix, tasks = None, []
+        for task in sorted(task_list):
+            if prefix and task.startswith(prefix):
+                continue
+            tasks.append(task)
+            prefix = Common.join_path(task, '')
+        files_from = '%s/files-from.Delete' % Global.G_RUN_DIR
+        if not FileOP.write_path_list(files_from, [os.path.relpath(task, base) for task in tasks]):
+            Logger.error("[threadDelete] write %s failed, retry %s deletes of %s later"
+                         % (files_from, len(tasks), listen))
+            [RetryQueue.push_task(Common.dirname(task)) for task in tasks]
+            return
+        rsh = '--rsh=%s' % SshPool.ssh_cmd()
+        cmd_dict = {}
+        for remote_ip in tpl.remote_ips:
+            if remote_ip not in Global.G_CONNECT_IP_LIST:
+                Logger.warn("[threadDelete] %s is unavailable IP, ignore %s deletes of %s"
+                            % (remote_ip, len(tasks), listen))
+                # 已删除的路径不在清单中，标记其所在目录，下次全量同步时同步
+                [SyncManifest.forget(Common.dirname(task)) for task in tasks]
+                continue
+            if not RemoteBreaker.allow(remote_ip):
+                due = RemoteBreaker.resume_at(remote_ip)
+                [RetryQueue.push_task(Common.dirname(task), failed=False, ip=remote_ip, due=due)
+                 for task in tasks]
+                continue
+            cmd_dict[remote_ip] = tpl.delete + ['--files-from=%s' % files_from, rsh, src,
+                                                '%s:%s' % (tpl.targets[remote_ip], src)]
+        for ip, (ret, out, err, cost) in self.fan_out(cmd_dict, self.rsync_batch).items():
+            RemoteBreaker.record(ip, ret)
+            if not ret:
+                Logger.info("[threadDelete] delete %s paths of %s, To %s, Cost time %.3fs"
+                            % (len(tasks), listen, ip, cost))
+                continue
+            Logger.error("[threadDelete] delete %s paths of %s on %s failed, (ret:%s, err:%s)"
+                         % (len(tasks), listen, ip, ret, err.strip()))
+            [RetryQueue.push_task(Common.dirname(task), ip=ip) for task in tasks]
+
+    def deal_batch(self, thread_id, task_list, is_retry=False, ips=None):
+        """
+        批量同步任务处理函数
+
+        任务按所在监听目录分组，每组对每个对端只执行一次rsync；
+        正在被其他线程同步的任务与deal相同，延后再尝试一次，仍冲突则丢弃
+
+        参数：
+            1. thread_id: 线程id
+            2. task_list: 该线程获取的任务列表
+            3. ips: 只同步到这些对端，None表示全部对端
+
+        返回值：None
+        """
+        collision = []
+        for tasks in [task_list, collision]:
+            groups = self.group_tasks(thread_id, tasks,
+                                      collision if tasks is task_list else None)
+            for (listen, last), _tasks in groups.items():
+                self.doing_batch(thread_id, listen, last, _tasks, is_retry, ips)
+
+    def group_tasks(self, thread_id, task_list, collision=None):
+        """
+        批量同步前的任务分组
+
+        过滤不存在或不在配置中的任务，按所在监听目录分组，
+        并批量创建各组在对端的同步根目录
+
+        参数：
+            collision: 用于暂存正在被其他线程同步的任务，None表示直接丢弃
+
+        返回值：
+            {(监听目录, 是否是上一次的配置): [任务]}
+        """
+        groups = OrderedDict()
+        for task in task_list:
+            if task in self.syncing:
+                if collision is None:
+                    Logger.debug("[thread%s] %s syncing still, ignored..."
+                                 % (thread_id, task))
+                else:
+                    Logger.debug("[thread%s] %s crash syncing" % (thread_id, task))
+                    collision.append(task)
+                continue
+            # 如果是临时目录或文件，同步可能会失败，需要判断一下目录或文件在不在
+            if not Common.is_exists(task):
+                Logger.warn("[thread%s] WarnExcept %s is not exist, ignore..."
+                            % (thread_id, task))
+                continue
+            listen, last = self.find_listen(task)
+            if not listen:
+                Logger.error("[thread%s] ErrorExcept %s not in config ini, ignore..."
+                             % (thread_id, task))
+                continue
+            if last:
+                Logger.warn('[thread%s] %s in last config section %s'
+                            % (thread_id, task, listen))
+            groups.setdefault((listen, last), []).append(task)
+        templates = [ListenIndex.template(listen, last) for listen, last in groups]
+        self.make_remote_dirs(thread_id, [(tpl, tpl.base) for tpl in templates])
+        return groups
+
+    def deal(self, thread_id, task_list, is_retry=False, large=False, ips=None):
         """
         同步任务处理函数
 
@@ -191,16 +687,28 @@ class Slaves(Singleton):
         参数：
             1. thread_id: 线程id
             2. task_list: 该线程获取的任务列表
+            3. large: 是否是大文件通道的任务，大文件逐个同步
+            4. ips: 只同步到这些对端，None表示全部对端
 
         返回值：None
         """
+        if self.batch_mode and not large:
+            return self.deal_batch(thread_id, task_list, is_retry, ips)
+
+        # 同步前批量创建各任务所在的对端目录
+        dir_list = []
+        for task in task_list:
+            listen, last = self.find_listen(task)
+            if listen:
+                dir_list.append((ListenIndex.template(listen, last), Common.dirname(task)))
+        self.make_remote_dirs(thread_id, dir_list)
 
         # 用于暂存冲突的task
         collision = []
         for task in task_list:
             # Logger.info("[thread%s] deal %s" % (thread_id, task))
             if task not in self.syncing:
-                self.doing(thread_id, task, is_retry)
+                self.doing(thread_id, task, is_retry, large, ips)
                 continue
             # task同步冲突时,暂存冲突的task，防止与其他线程重复同步
             Logger.debug("[thread%s] %s crash syncing" % (thread_id, task))
@@ -209,7 +717,7 @@ class Slaves(Singleton):
         # 处理上一个循环中加入的冲突task
         for task in collision:
             if task not in self.syncing:
-                self.doing(thread_id, task, is_retry)
+                self.doing(thread_id, task, is_retry, large, ips)
                 continue
             # 如果仍然冲突，那就直接丢弃
             Logger.debug("[thread%s] %s syncing still, ignored..."
@@ -219,7 +727,8 @@ class Slaves(Singleton):
         """
         线程池处理函数
 
-        请求同步任务并进行处理
+        阻塞请求同步任务并进行处理，任务入队即被唤醒；
+        处理完后不再休眠，立即请求下一批，直到队列为空
 
         参数：
             args: 暂只包含线程id
@@ -227,19 +736,32 @@ class Slaves(Singleton):
         返回值: None
         """
         thread_id, = args
-        task_list = TaskQueue.request_tesk()
+        task_list = TaskQueue.request(timeout=self.worker_wait)
         if not task_list:
             return
         Logger.info("[thread%s] got %s tasks:\n%s"
                     % (thread_id, len(task_list), '\n'.join(task_list)))
-        self.set_config_data()
-        self.deal(thread_id, task_list)
+        try:
+            self.deal(thread_id, task_list)
+        finally:
+            TaskQueue.done(task_list)
 
-    def set_config_data(self):
-        _curr = ConfigWrapper.get_listen_path(last=False)
-        if self.curr_listen != _curr:
-            self.curr_listen = _curr
-            self.last_listen = ConfigWrapper.get_listen_path(last=True)
+    def require_large(self, args=None):
+        """
+        大文件工作线程处理函数
+
+        与require相同，但只处理大文件通道的任务，
+        大文件同步耗时长，不占用普通工作线程
+        """
+        thread_id = 'Large%s' % args[0]
+        task_list = TaskQueue.request_large(timeout=self.worker_wait)
+        if not task_list:
+            return
+        Logger.info("[thread%s] got large file %s" % (thread_id, task_list[0]))
+        try:
+            self.deal(thread_id, task_list, large=True)
+        finally:
+            TaskQueue.done(task_list)
 
     def wait_for_ready(self):
         while 1:
@@ -252,7 +774,8 @@ class Slaves(Singleton):
         失败重传线程处理函数
 
         小周期定时任务
-        失败重传线程从失败重传队列中获取任务进行重传处理
+        失败重传线程从失败重传队列中获取任务进行重传处理，
+        按待重传的对端分组，只重传到失败或熔断的对端
 
         参数：None
 
@@ -261,8 +784,14 @@ class Slaves(Singleton):
         task_list = RetryQueue.request_task()
         if not task_list:
             return
-        self.set_config_data()
-        self.deal('Retry', task_list, True)
+        groups = OrderedDict()
+        for task, ips in task_list:
+            groups.setdefault(ips, []).append(task)
+        try:
+            for ips, _tasks in groups.items():
+                self.deal('Retry', _tasks, True, ips=ips)
+        finally:
+            RetryQueue.done([task for task, _ in task_list])
 
     def connect_check(self, args=None):
         """
@@ -279,21 +808,37 @@ class Slaves(Singleton):
                     if ip not in _tmp_ip:
                         _tmp_ip.append(ip)
         """ 保存正常连接的IP """
-        for ip, result in Common.batch_ping(_tmp_ip).items():
+        if self.probe_method == 'ping':
+            results = Common.batch_ping(_tmp_ip)
+        else:
+            results = TcpProber.probe(_tmp_ip)
+        for ip, result in results.items():
             if not result:
                 Logger.warn('[fs_slaves] %s is disconnect' % ip)
                 if ip in Global.G_CONNECT_IP_LIST:
                     Global.G_CONNECT_IP_LIST.remove(ip)
             elif ip not in Global.G_CONNECT_IP_LIST:
                 Global.G_CONNECT_IP_LIST.append(ip)
+        """ 维持可达IP的SSH复用连接 """
+        SshPool.keepalive(Global.G_CONNECT_IP_LIST)
+        """ 探测熔断的对端 """
+        RemoteBreaker.probe(self.probe_remote)
         self.ready_flag = True
         Logger.info('[fs_slaves] after check connect G_CONNECT_IP_LIST=%s' % Global.G_CONNECT_IP_LIST)
 
+    def probe_remote(self, ip):
+        """ 登录对端执行空命令，返回退出值 """
+        cmd = SshPool.ssh_argv() + ['%s@%s' % (Global.G_RSYNC_USER, ip), 'true']
+        return self.exec_remote(ip, cmd)[0]
+
     def fully_sync(self, args=None):
         """
         大周期定时任务
         负责全量数据同步(只做当前配置文件的全量同步)
 
+        开启incremental_full_sync时，扫描监听目录与本地清单比较，
+        只同步有变化的路径，已删除的路径放入删除队列；没有清单时同步整个监听目录
+
         注：首次启动时，需要等待IP检测（connect_check）完，
         否则首次全量数据同步会误认为对端IP不可用
         """
@@ -306,19 +851,124 @@ class Slaves(Singleton):
                                                           )
             if sync_all_switch == 'false':
                 continue
-            task_list.append(listen)
-        self.set_config_data()
-        # 全量同步不进行失败重传
-        self.deal('Full', task_list, True)
+            if self.merkle_reconcile:
+                changed, deleted = self.reconcile(listen)
+                task_list.extend(changed)
+                [self.push_delete(path) for path in deleted]
+                continue
+            if not self.incremental_full_sync:
+                task_list.append(listen)
+                continue
+            manifest = SyncManifest(listen)
+            changed, deleted, entries = manifest.diff()
+            # 先保存清单，因对端不可达未同步或同步最终失败的路径由SyncManifest.forget标记
+            manifest.save(entries)
+            if changed is None:
+                Logger.info("[fs_slaves] no manifest of %s, sync all" % listen)
+                task_list.append(listen)
+                continue
+            Logger.info("[fs_slaves] %s: %s paths scanned, %s changed, %s deleted"
+                        % (listen, len(entries), len(changed), len(deleted)))
+            task_list.extend(changed)
+            [self.push_delete(path) for path in deleted]
+        if not task_list:
+            return
+        # 失败的路径与普通任务一样进入失败重传队列
+        self.deal('Full', task_list)
+
+    def reconcile(self, listen):
+        """
+        Merkle树对账
+
+        本端计算监听目录的Merkle树，经ssh在各对端启动应答进程计算同一棵树，
+        逐层只深入哈希不同的子目录；
+        与某个对端对账失败时，退化为同步整个监听目录
+
+        返回值：
+            需要同步的路径列表(各对端的并集);
+            需要在对端删除的路径列表(各对端的并集)
+        """
+        if not Common.is_dir(listen):
+            return [listen], []
+        tpl = ListenIndex.template(listen, False)
+        tree = MerkleTree(listen, tpl.excludes)
+        tree.build()
+        remote_cmd = ' '.join([Common.quote(arg) for arg in
+                               [self.merkle_python, '-c', MerkleTree.source(), listen] + tpl.excludes])
+        cmd_dict = dict((ip, SshPool.ssh_argv() + [tpl.targets[ip], remote_cmd])
+                        for ip in tpl.remote_ips if ip in Global.G_CONNECT_IP_LIST)
+
+        def diff(ip, cmd):
+            session = None
+            try:
+                session = MerkleSession(cmd, self.rsync_timeout)
+                return tree.diff(session.query)
+            except (IOError, OSError, ValueError) as e:
+                return e
+            finally:
+                if session:
+                    session.close()
+
+        task_list, delete_list = set(), set()
+        for ip, result in self.fan_out(cmd_dict, diff).items():
+            if isinstance(result, Exception):
+                Logger.warn("[fs_slaves] reconcile %s with %s failed: %s, sync all"
+                            % (listen, ip, result))
+                return [listen], []
+            tasks, deletes = result
+            Logger.info("[fs_slaves] reconcile %s with %s: %s paths differ, %s paths to delete"
+                        % (listen, ip, len(tasks), len(deletes)))
+            task_list.update(tree.path(rel) for rel in tasks)
+            delete_list.update(tree.path(rel) for rel in deletes)
+        return sorted(task_list), sorted(delete_list)
 
     def start_worker(self):
-        """ 启动任务处理工作线程 """
+        """
+        启动任务处理工作线程
+
+        可选项sync_engine为asyncio时，使用asyncio同步引擎代替工作线程池
+        """
+        engine = ConfigWrapper.get_key_value('sync_engine') or 'thread'
+        if engine == 'asyncio':
+            if AsyncEngine is None:
+                Logger.warn('[fs_slaves] asyncio engine is unavailable, use thread')
+            else:
+                concurrency = int(ConfigWrapper.get_key_value('async_concurrency') or 64)
+                Logger.info('[fs_slaves] sync engine: asyncio, concurrency: %s' % concurrency)
+                self.pool = AsyncEngine(self, concurrency)
+                self.pool.start()
+                return
+        # 等待由TaskQueue.request完成，线程无需再周期休眠
         self.pool = ThreadPool(func=self.require,
-                               period=self.worker_period
+                               period=0
                                )
         self.pool.init(self.count)
         self.pool.start()
 
+    def start_large_worker(self):
+        """ 启动大文件工作线程，同步引擎为asyncio时同样使用线程 """
+        if not TaskQueue.has_large_lane():
+            return
+        # 可选项，大文件工作线程数，默认1
+        count = int(ConfigWrapper.get_key_value('large_file_workers') or 1)
+        self.large_pool = ThreadPool(func=self.require_large,
+                                     period=0
+                                     )
+        self.large_pool.init(count)
+        self.large_pool.start()
+
+    def start_mover(self):
+        """ 启动对端移动线程 """
+        MyThreading(func=self.move_process,
+                    period=0
+                    ).start()
+
+    def start_deleter(self):
+        """ 启动批量删除线程 """
+        MyThreading(func=self.delete_process,
+                    period=0
+                    ).start()
+
     def start_retry(self):
         """ 启动失败重传任务线程 """
         MyThreading(func=self.retry_process,
@@ -335,22 +985,48 @@ class Slaves(Singleton):
         """ 启动全量数据同步任务线程 """
         period = float(ConfigWrapper.get_key_value('fullsync_period'))
         MyThreading(func=self.fully_sync,
+                    behind=self.defer_full_sync,
                     period=period
                     ).start()
 
+    def set_timeout(self):
+        """ 可选项，单次rsync同步超时时间(秒)，超时后kill，默认3600 """
+        self.rsync_timeout = float(ConfigWrapper.get_key_value('rsync_timeout') or 3600)
+
     def start(self):
+        self.set_batch_mode()
+        self.set_full_sync_mode()
+        self.set_timeout()
+        # 可选项，每个对端缓存的已存在目录个数，默认10000
+        RemoteDirCache.init(int(ConfigWrapper.get_key_value('remote_dir_cache_size') or 10000))
+        self.set_remote_limit()
+        SshPool.init()
+        RemoteBreaker.init()
+        BandwidthGovernor.init()
+        CompressAdvisor.init()
+        # 可选项，对端可达性探测方式：tcp(连接SSH端口，默认)或ping
+        self.probe_method = ConfigWrapper.get_key_value('probe_method') or 'tcp'
+        TcpProber.init()
         self.start_checker()
         self.start_worker()
+        self.start_large_worker()
+        self.start_mover()
+        self.start_deleter()
         self.start_retry()
         self.start_fullsync()
 
     def status(self):
-        return self.syncing, Global.G_CONNECT_IP_LIST
+        return self.syncing, Global.G_CONNECT_IP_LIST, TcpProber.status(), CompressAdvisor.status()
+
+    def stop(self):
+        SshPool.close()
 
     def pause(self):
-        if self.pool:
-            self.pool.pause()
+        for pool in [self.pool, self.large_pool]:
+            if pool:
+                pool.pause()
 
     def resume(self):
-        if self.pool:
-            self.pool.resume()
+        for pool in [self.pool, self.large_pool]:
+            if pool:
+                pool.resume()
@@ -9,17 +9,21 @@ import re
 import sys
 import pwd
 import time
+import stat
 import errno
 import getpass
 import atexit
 import signal
+import select
 import threading
 import subprocess
 from fs_message import Subscriber
 if sys.version_info[0] == 2:
     import ConfigParser
+    from pipes import quote
 else:
     import configparser as ConfigParser
+    from shlex import quote
 
 
 class Singleton(object):
@@ -158,6 +162,19 @@ class Common:
     def is_dir(cls, path):
         return os.path.isdir(path)
 
+    @classmethod
+    def realpath(cls, path):
+        return os.path.realpath(path)
+
+    @classmethod
+    def file_size(cls, path):
+        """ 文件大小，目录返回None，路径不存在返回0 """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 0
+        return None if stat.S_ISDIR(st.st_mode) else st.st_size
+
     @classmethod
     def is_contain(cls, directory, file):
         # directory = os.path.join(os.path.realpath(directory), '')
@@ -167,6 +184,11 @@ class Common:
             return True
         return os.path.commonprefix([file, directory]) == directory
 
+    @classmethod
+    def quote(cls, arg):
+        """ shell参数转义 """
+        return quote(arg)
+
     @classmethod
     def stream_2_str(cls, in_ss):
         if sys.version_info[0] == 2:
@@ -175,23 +197,17 @@ class Common:
             return str(in_ss, encoding='utf-8')
 
     @classmethod
-    def exec_ret(cls, cmd):
-        return cls.shell_cmd(cmd)[0]
+    def exec_ret(cls, argv, timeout=None):
+        return Executor.run(argv, timeout)[0]
 
     @classmethod
-    def shell_cmd(cls, cmd):
-        p = subprocess.Popen([cmd],
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             shell=True)
-        out, err = p.communicate()
-        return p.returncode, cls.stream_2_str(out), cls.stream_2_str(err)
+    def exec_cmd(cls, argv, timeout=None):
+        return Executor.run(argv, timeout)
 
     @classmethod
     def batch_ping(cls, ip_list):
         def ping(_ip):
-            ret = cls.exec_ret("ping -c 1 -W 1 {0}".format(_ip))
+            ret = cls.exec_ret(['ping', '-c', '1', '-W', '1', _ip], timeout=5)
             result[_ip] = True if not ret else False
 
         result, threads = {}, []
@@ -202,6 +218,167 @@ class Common:
         return result
 
 
+class Executor:
+    """
+    命令执行类
+
+    不经过shell，直接以参数列表执行命令：
+        1. 支持posix_spawn时直接spawn子进程，省去fork整个进程的开销；
+        2. 子进程运行在独立的进程组中，超时后整组kill(包括rsync拉起的ssh)；
+        3. 边执行边读取stdout/stderr，超出capture_size的部分丢弃，内存占用有上限
+    """
+    capture_size = 1048576
+    read_size = 65536
+
+    @classmethod
+    def _spawn(cls, argv, output):
+        """
+        启动子进程
+
+        返回值：
+            pid, stdout读端, stderr读端, Popen对象(posix_spawn方式为None)
+        """
+        if hasattr(os, 'posix_spawnp'):
+            actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0)]
+            fds = []
+            if output:
+                r_out, w_out = os.pipe()
+                r_err, w_err = os.pipe()
+                fds = [w_out, w_err]
+                # pipe默认close-on-exec，dup2后的1/2不受影响
+                actions += [(os.POSIX_SPAWN_DUP2, w_out, 1),
+                            (os.POSIX_SPAWN_DUP2, w_err, 2)]
+            else:
+                r_out = r_err = None
+                actions += [(os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                            (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0)]
+            try:
+                pid = os.posix_spawnp(argv[0], argv, os.environ,
+                                      file_actions=actions, setpgroup=0)
+            except OSError:
+                [os.close(fd) for fd in fds + [r_out, r_err] if fd is not None]
+                raise
+            [os.close(fd) for fd in fds]
+            return pid, r_out, r_err, None
+
+        kwargs = {}
+        if sys.version_info[0] == 2:
+            kwargs['preexec_fn'] = os.setsid
+        else:
+            kwargs['start_new_session'] = True
+        devnull = open(os.devnull, 'r+')
+        pipe = subprocess.PIPE if output else devnull
+        try:
+            proc = subprocess.Popen(argv,
+                                    stdin=devnull,
+                                    stdout=pipe,
+                                    stderr=pipe,
+                                    close_fds=True,
+                                    **kwargs)
+        finally:
+            devnull.close()
+        if not output:
+            return proc.pid, None, None, proc
+        return proc.pid, proc.stdout.fileno(), proc.stderr.fileno(), proc
+
+    @classmethod
+    def _poll(cls, pid, proc):
+        """ 非阻塞获取退出值，未退出返回None """
+        if proc is not None:
+            return proc.poll()
+        try:
+            _pid, status = os.waitpid(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return None
+            raise
+        if not _pid:
+            return None
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    @classmethod
+    def _wait(cls, pid, proc, deadline):
+        """ 等待子进程退出，超过deadline返回None """
+        delay = 0.001
+        while True:
+            ret = cls._poll(pid, proc)
+            if ret is not None:
+                return ret
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    @classmethod
+    def _decode(cls, chunks):
+        data = b''.join(chunks)
+        if sys.version_info[0] == 2:
+            return data
+        return data.decode('utf-8', 'replace')
+
+    @classmethod
+    def run(cls, argv, timeout=None, output=True):
+        """
+        执行命令
+
+        参数：
+            argv: 命令参数列表
+            timeout: 超时时间(秒)，超时后kill整个进程组，None表示不超时
+            output: 是否读取输出，False时输出重定向到/dev/null，
+                    用于会在后台常驻的命令(如ssh -f)
+
+        返回值：
+            退出值(被信号杀死时为负的信号值，无法执行时为127), stdout, stderr
+        """
+        try:
+            pid, r_out, r_err, proc = cls._spawn(argv, output)
+        except OSError as e:
+            return 127, '', '%s: %s' % (argv[0], e)
+
+        deadline = time.time() + timeout if timeout else None
+        chunks = {r_out: [], r_err: []}
+        sizes = {r_out: 0, r_err: 0}
+        opened = [fd for fd in (r_out, r_err) if fd is not None]
+        timed_out = False
+        while opened:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    timed_out = True
+                    break
+            try:
+                readable = select.select(opened, [], [], wait)[0]
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                data = os.read(fd, cls.read_size)
+                if not data:
+                    opened.remove(fd)
+                    continue
+                if sizes[fd] < cls.capture_size:
+                    chunks[fd].append(data[:cls.capture_size - sizes[fd]])
+                sizes[fd] += len(data)
+        if proc is None:
+            [os.close(fd) for fd in (r_out, r_err) if fd is not None]
+        ret = None if timed_out else cls._wait(pid, proc, deadline)
+        if ret is None:
+            timed_out = True
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            ret = cls._wait(pid, proc, None)
+        out, err = cls._decode(chunks[r_out]), cls._decode(chunks[r_err])
+        if timed_out:
+            err += '\ntimeout after %ss, killed' % timeout
+        return ret, out, err
+
+
 class FileOP:
     """ 文件操作 """
 
@@ -231,6 +408,25 @@ class FileOP:
         except:
             return False
 
+    @classmethod
+    def write_path_list(cls, filename, path_list):
+        """
+        写入rsync --files-from --from0文件，路径以NUL分隔
+
+        路径中不能按UTF-8解码的字节(native监听以surrogateescape保留)原样写回
+
+        返回值：是否写入成功
+        """
+        data = '\0'.join(path_list)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'surrogateescape')
+        try:
+            with open(filename, 'wb') as f:
+                f.write(data)
+            return True
+        except (IOError, OSError):
+            return False
+
     @classmethod
     def rm_file(cls, srcfile):
         try:
@@ -0,0 +1,107 @@
+# -*- coding: UTF-8 -*-
+"""
+同步延迟测试工具
+
+在临时目录中搭建 native inotify -> Master -> TaskQueue -> Slaves 的完整链路，
+rsync替换为立即返回的空命令，逐个写入文件，
+统计从文件写关闭到该任务同步完成的延迟分布
+
+调用方式:
+    python bench_latency.py [count]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fs_global as Global
+Global.G_LOG_FILE = os.devnull
+from fs_message import Receiver
+from fs_inotify import NativeWatcher, IN_CLOSE_WRITE
+from fs_data import ConfigData, ConfigWrapper, ListenIndex, EventQueue, TaskQueue, RetryQueue
+from fs_master import Master
+from fs_slaves import Slaves
+
+
+def setup(root):
+    Global.G_RUN_DIR = root
+    Global.G_RSYNC_TOOL = 'true'
+    Global.G_RSYNC_USER = 'bench'
+    Global.G_CONNECT_IP_LIST[:] = ['127.0.0.1']
+    listen = os.path.join(root, 'listen')
+    os.mkdir(listen)
+    ConfigWrapper.init()
+    ConfigData._curr_config = {'GLOBAL': {'sync_period': '1',
+                                          'make_remote_dir': 'false'},
+                               listen: {'remote_ip': '127.0.0.1',
+                                        'checksum': 'false',
+                                        'compress': 'false'}}
+    ListenIndex.build(ConfigWrapper.get_listen_path(), [])
+    TaskQueue.init(100000, 5, 0)
+    RetryQueue.init(10000)
+    return listen
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) == 2 else 200
+    root = tempfile.mkdtemp()
+    try:
+        listen = setup(root)
+        written, synced = {}, {}
+
+        if not NativeWatcher.available():
+            print('native inotify is unavailable')
+            return
+        event_queue = EventQueue()
+        Receiver.bind(Global.G_INOTIFY_EVENT_MSGID, lambda param: event_queue)
+        watcher = NativeWatcher(IN_CLOSE_WRITE, lambda events: event_queue.put_many(
+            [(event, path) for event, path, cookie in events]))
+        watcher.open([listen])
+        watcher.start()
+
+        slaves = Slaves(5)
+        _report = slaves.report_batch
+
+        def report_batch(thread_id, _listen, base, task_list, results, is_retry):
+            now = time.time()
+            for task in task_list:
+                synced.setdefault(task, now)
+            _report(thread_id, _listen, base, task_list, results, is_retry)
+        slaves.report_batch = report_batch
+        slaves.set_remote_limit()
+        slaves.set_timeout()
+        slaves.start_worker()
+        # 不等待路径静默，只统计链路本身的延迟
+        master = Master()
+        master.settle_time = 0
+        master.handle_event()
+
+        # 每个文件单独一个目录，文件事件对应的任务为该文件
+        for i in range(count):
+            _dir = os.path.join(listen, str(i))
+            os.mkdir(_dir)
+            # 等待新目录加入监听
+            time.sleep(0.01)
+            path = os.path.join(_dir, 'file')
+            written[path] = time.time()
+            with open(path, 'w') as f:
+                f.write('x')
+            time.sleep(0.02)
+        time.sleep(1)
+        watcher.close()
+
+        lags = sorted([(synced[d] - t) * 1000 for d, t in written.items() if d in synced])
+        if not lags:
+            print('no task synced')
+            return
+        print('synced %s/%s' % (len(lags), count))
+        for p in (50, 90, 99):
+            print('p%s: %.1f ms' % (p, lags[min(len(lags) - 1, len(lags) * p // 100)]))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+"""
+任务队列性能测试工具
+
+分别在不同队列长度下测量TaskQueue入队(含去重)和出队的单次耗时，
+单次耗时不应随队列长度增长
+
+调用方式:
+    python bench_queue.py [max_size]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fs_global as Global
+Global.G_LOG_FILE = os.devnull
+from fs_data import ConfigData, ConfigWrapper, ListenIndex, TaskQueue, DrrScheduler
+
+
+def setup():
+    ConfigWrapper.init()
+    ConfigData._curr_config = {'GLOBAL': {}, '/bench': {'remote_ip': '127.0.0.1'}}
+    ListenIndex.build(ConfigWrapper.get_listen_path(), [])
+
+
+def new_scheduler():
+    """ 与默认配置一致，使用按监听目录公平调度 """
+    return DrrScheduler(2.0)
+
+
+def bench_push(size):
+    """ 队列中已有size个任务时，再入队(含重复任务)的单次耗时 """
+    count = 10000
+    # 预留足够空间，避免触发队列告警日志影响测量
+    TaskQueue.init((size + count) * 4, 5, 0, new_scheduler())
+    [TaskQueue.push_task('/bench/%s' % i) for i in range(size)]
+    start = time.time()
+    for i in range(count):
+        TaskQueue.push_task('/bench/new/%s' % i)
+        TaskQueue.push_task('/bench/%s' % (i % size))
+    return (time.time() - start) / (count * 2)
+
+
+def bench_request(size):
+    """ 队列中已有size个任务时，出队的单个任务耗时 """
+    TaskQueue.init(size * 4, 5, 0, new_scheduler())
+    [TaskQueue.push_task('/bench/%s' % i) for i in range(size)]
+    count = 0
+    start = time.time()
+    while True:
+        tasks = TaskQueue.request(timeout=0)
+        if not tasks:
+            break
+        count += len(tasks)
+    return (time.time() - start) / count
+
+
+def main():
+    max_size = int(sys.argv[1]) if len(sys.argv) == 2 else 100000
+    size = 1000
+    setup()
+    print('%10s %14s %14s' % ('queue', 'push(us/op)', 'request(us/op)'))
+    while size <= max_size:
+        print('%10s %14.3f %14.3f' % (size,
+                                      bench_push(size) * 1e6,
+                                      bench_request(size) * 1e6))
+        size *= 10
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)